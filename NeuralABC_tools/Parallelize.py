@@ -1,98 +1,1248 @@
+import collections
+import functools
+import hashlib
+import itertools
+import json
+import mmap
 import multiprocessing
-from multiprocessing import Pool
+import os
+import pickle
+import threading
+import time
+import traceback
+import types
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing import shared_memory as _shared_memory
 import numpy as np
 
-def __processor_procedure(processor_index, ranges, f):
+try:
+    import resource
+except ImportError: #not available on Windows, the memory high-water mark is then not reported
+    resource = None
+
+#The backends accepted by Parallelize()
+_BACKENDS = ("process", "thread", "batch", "auto")
+
+#The layouts accepted by the ragged parameter of Parallelize()
+_RAGGED = (None, "list", "offsets")
+
+#Number of elements timed by the backend="auto" probe, and the estimated runtime under which starting processes is not worth it
+_AUTO_PROBE_SIZE = 4
+_AUTO_MIN_PROCESS_TIME = 0.2
+
+def __processor_procedure(chunk, f, source=None, sink=None, profile=False, errors="raise", retries=0, casting="same_kind"):
     """
     __processor_procedure() is a helper function for Paralellize() and there is no reason for the user to manually call this function
-    One instance of this function is run per core. The number of cores can be specified in the parameters of Parallelize()
-    
+    One call of this function processes one chunk of elements. Idle workers pull the next chunk from the pool, so the work is
+    balanced dynamically between the cores. The number of cores can be specified in the parameters of Parallelize()
+
+    Parameters:
+    ----------------
+    :param chunk: (range) required: The indices of the elements in the data that the function is responsible for processing
+    :param f: (function) required: The function that the elements will be passed to
+    :param source: (tuple) optional: Where the elements are read from. None for the global variable set by Parallelize(),
+                   ("rows", elements) when the elements of the chunk were sent with the task, or the spec of a shared array
+    :param sink: (tuple) optional: The spec of the shared array or memmap the outputs are written into. If None, the outputs are returned
+    :param profile: (bool) optional: Time every element and the serialization of the outputs, see ParallelStats. Default = False
+    :param errors: (string) optional: "raise" or "return", see Parallelize(). Default = "raise"
+    :param retries: (int) optional: Number of extra attempts for an element whose f call raised, see Parallelize(). Default = 0
+    :param casting: (string) optional: The numpy casting rule of the outputs written into the sink, see _write_rows(). Default = "same_kind"
+
+    Returns:
+    ----------------
+    (chunk, outputs, report, failures) where outputs is the list of outputs of f, or None if they were written into the sink.
+    When profiling, the outputs are returned already pickled and report is a dict of timings, otherwise report is None.
+    failures is the list of ElementError of the elements that failed with errors="return", or None
+    """
+    #Attached shared memory blocks are only closed once the arrays viewing them are gone
+    blocks = []
+    try:
+        return __run_chunk(chunk, f, source, sink, blocks, profile, errors, retries, casting)
+    finally:
+        for shm in blocks:
+            _close_shared(shm)
+
+
+def __star_processor_procedure(args):
+    """
+    Unpack the arguments of __processor_procedure(), for Pool.imap_unordered()
+    """
+    return __processor_procedure(*args)
+
+
+def __run_chunk(chunk, f, source, sink, blocks, profile, errors, retries, casting):
+    """
+    __run_chunk() does the work of __processor_procedure(). See __processor_procedure() for the parameters
+    """
+    if source is None:
+        '''
+        Reference the global variable defined in Parallelize(). This is a "hacky" trick to grab the input data without
+        directly passing a copy of it to each function, which would waste time and resources
+        '''
+        global __48162789682__
+        data = __48162789682__
+        elements = (data[index] for index in chunk)
+    elif source[0] == "rows":
+        elements = iter(source[1])
+    else:
+        data = _attach_array(source, blocks)
+        elements = (data[index] for index in chunk)
+
+    #The default path calls f directly, the wrappers are only added when they are asked for
+    guarded = errors != "raise" or retries > 0
+    if guarded:
+        f = _guarded(f, errors, retries)
+    if profile:
+        report = _new_report(os.getpid())
+        f = _timed(f, report["item_times"])
+    else:
+        report = None
+
+    #Process the data by running it through the f() function
+    if sink is None:
+        outputs = [f(element) for element in elements]
+        if blocks: #the shared input is closed before the outputs are sent back, so they must not be views of it
+            outputs = [_detached(output, data) for output in outputs]
+        failures = _failures(chunk, outputs) if guarded else None
+        if not profile:
+            return chunk, outputs, None, failures
+
+        #Pickle the outputs here so that the serialization time can be told apart from the compute time
+        start = time.perf_counter()
+        outputs = pickle.dumps(outputs, protocol=pickle.HIGHEST_PROTOCOL)
+        report["serialization_time"] = time.perf_counter() - start
+        report["max_rss"] = _max_rss()
+        return chunk, outputs, report, failures
+
+    out = _attach_array(sink, blocks)
+    failures = []
+    for index, element in zip(chunk, elements):
+        output = f(element)
+        if guarded and isinstance(output, ElementError):
+            output.index = index
+            failures.append(output)
+        else:
+            _write_rows(out, index, np.reshape(output, -1), casting)
+    if isinstance(out, np.memmap):
+        out.flush()
+    if profile:
+        report["max_rss"] = _max_rss()
+    return chunk, None, report, failures or None
+
+
+def _write_rows(target, rows, block, casting):
+    """
+    Write outputs into rows of the result array. The size and type of the rows are set by the first outputs (or by out or
+    dtype), so later outputs of another size raise instead of being broadcast, and outputs that cannot be cast to the type
+    under casting (e.g. floats after ints) raise instead of being truncated
+
+    :param target: (ndarray) required: the result array, or the sink of the workers
+    :param rows: (int or slice) required: the rows written
+    :param block: (ndarray) required: the outputs, one row per element (or the row of one element)
+    :param casting: (string) required: "same_kind", or "unsafe" when the type was asked for with dtype
+    """
+    if(block.shape[-1] != target.shape[1]):
+        raise ValueError(f"f returned outputs of size {block.shape[-1]} and {target.shape[1]}, use ragged='list' or ragged='offsets'")
+    if not np.can_cast(block.dtype, target.dtype, casting):
+        raise ValueError(f"f returned outputs of type {block.dtype}, which cannot be stored in the result of type {target.dtype} "
+                         "without loss. Return outputs of a single type, or set the type of the result with dtype")
+    target[rows] = block
+
+
+def _detached(output, data):
+    """
+    Return output, or a copy of it if it is an array (or a list or tuple of arrays) viewing the memory of data
+    """
+    if isinstance(output, np.ndarray):
+        return output.copy() if np.may_share_memory(output, data) else output
+    if isinstance(output, (list, tuple)):
+        return type(output)(_detached(item, data) for item in output)
+    return output
+
+
+class ElementError(Exception):
+    def __init__(self, index, error, traceback_text):
+        """
+        ElementError describes an element of data for which f raised, with Parallelize(errors="return"). It stands in for
+        the output of that element in ragged="list" results and is listed in the failures returned by Parallelize().
+        It only holds text, so it can always be sent back from the workers, whatever the original exception was.
+
+        Constructor parameters:
+        ----------------
+        :param index: (int), required: The index of the element in data
+        :param error: (string), required: repr() of the exception raised by f
+        :param traceback_text: (string), required: The formatted traceback of the exception
+        """
+        super().__init__(index, error, traceback_text)
+        self.index = index
+        self.error = error
+        self.traceback_text = traceback_text
+
+    def __str__(self):
+        return f"element {self.index} failed: {self.error}"
+
+
+def _guarded(f, errors, retries):
+    """
+    Wrap f so that a call that raises is attempted again up to retries times. If it still raises, the exception is
+    raised again if errors is "raise", and returned as an ElementError (without its index) if errors is "return"
+
+    :param f: (function) required: the function to wrap
+    :param errors: (string) required: "raise" or "return"
+    :param retries: (int) required: the number of extra attempts
+    :return: function
+    """
+    def guarded_f(element):
+        for attempt in range(retries + 1):
+            try:
+                return f(element)
+            except Exception as error:
+                if attempt < retries:
+                    continue
+                if errors == "raise":
+                    raise
+                return ElementError(None, repr(error), traceback.format_exc())
+    return guarded_f
+
+
+def _failures(chunk, outputs):
+    """
+    Set the index of the ElementError among the outputs of a chunk and return them, or None if there are none
+    """
+    failures = []
+    for index, output in zip(chunk, outputs):
+        if isinstance(output, ElementError):
+            output.index = index
+            failures.append(output)
+    return failures or None
+
+
+def _new_report(worker):
+    """
+    Create the timing report of one chunk, filled by __run_chunk() when profiling
+
+    :param worker: (int) required: identifier of the process or thread running the chunk
+    :return: dict
+    """
+    return {"worker": worker, "item_times": [], "serialization_time": 0.0, "max_rss": None}
+
+
+def _timed(f, item_times):
+    """
+    Wrap f so that the duration of every call is appended to item_times
+
+    :param f: (function) required: the function to time
+    :param item_times: (list) required: receives the duration of every call in seconds
+    :return: function
+    """
+    def timed_f(element):
+        start = time.perf_counter()
+        output = f(element)
+        item_times.append(time.perf_counter() - start)
+        return output
+    return timed_f
+
+
+def _max_rss():
+    """
+    Return the memory high-water mark of the current process in bytes, or None if it cannot be measured
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return max_rss if os.uname().sysname == "Darwin" else max_rss * 1024
+
+
+def _attach_array(spec, blocks):
+    """
+    Open the array described by spec in the current process without copying it
+
+    :param spec: (tuple) required: ("shm", name, shape, dtype) for a shared memory block, or ("memmap", filename, shape, dtype, offset)
+    :param blocks: (list) required: attached shared memory blocks are appended to it so that the caller can close them
+    :return: ndarray or np.memmap
+    """
+    if spec[0] == "shm":
+        shm = _shared_memory.SharedMemory(name=spec[1])
+        blocks.append(shm)
+        return np.ndarray(spec[2], dtype=spec[3], buffer=shm.buf)
+    return np.memmap(spec[1], dtype=spec[3], mode="r+", offset=spec[4], shape=spec[2])
+
+
+def _close_shared(shm, unlink=False):
+    """
+    Close (and optionally unlink) a shared memory block
+
+    :param shm: (SharedMemory) required: the block
+    :param unlink: (bool) optional: also free the block. Only the process that created it should do so. Default = False
+    """
+    if unlink:
+        shm.unlink()
+    try:
+        shm.close()
+    except BufferError: #the views are still alive after a failure, the mapping is released together with them
+        pass
+
+
+def __chunk_procedure(chunk, f):
+    """
+    __chunk_procedure() is a helper function for imap() and ParallelExecutor and there is no reason for the user to manually
+    call this function. One call of this function processes one chunk of elements that was sent to the worker together with the task
+
     Parameters:
     ----------------
-    :param processor_index: (integer) required: The index of the processor which this function is running on
-    :param ranges: (dictionary) required: The list of elements that the function is responsible for processing is contained in this dictionary
+    :param chunk: (list or Numpy array) required: The elements to process
     :param f: (function) required: The function that the elements will be passed to
     """
-    
+    return [f(element) for element in chunk]
 
-    '''
-    Reference the global variable defined in Parallelize(). This is a "hacky" trick to grab the input data without 
-    directly passing a copy of it to each function, which would waste time and resources
-    '''
+
+def __set_global_data(data):
+    """
+    __set_global_data() is a Pool initializer used by Parallelize() when the workers are not forked from the parent
+    process (i.e. the "spawn" and "forkserver" start methods), in which case the global variable is not inherited
+
+    Parameters:
+    ----------------
+    :param data: (Python array or Numpy array) required: the sequence of data to be processed
+    """
     global __48162789682__
-    data = __48162789682__
-    
-    #Create the dictionary of outputs
-    __processed = {}
-    
-    #If one passes the "processor_index" variable to the dictionary "ranges" as a key, the value received is an array
-    #of element indices that specify which elements in the data the function must process
-    for index in ranges[processor_index]:
-        #Process the data by running it through the f() function
-        _out = f(data[index])
-        __processed[index] = _out
+    __48162789682__ = data
+
+
+def __run_initializer(initializer, initargs):
+    """
+    __run_initializer() is the Pool initializer of ParallelExecutor. It runs the user initializer once per worker and keeps
+    its return value, which f can then retrieve with worker_state()
 
-    return __processed
+    Parameters:
+    ----------------
+    :param initializer: (function) required: The user initializer, or None
+    :param initargs: (tuple) required: The arguments passed to the user initializer
+    """
+    global __48162789685__
+    __48162789685__ = None if initializer is None else initializer(*initargs)
 
 
+def worker_state():
+    """
+    Return the value returned by the initializer of the ParallelExecutor that started the current worker. This lets f
+    use heavy per-worker state (e.g. a nibabel mask) that is loaded once per worker instead of once per element
 
-def Parallelize(data, f, num_cores=None):
+    :return: the return value of the initializer, or None if there was no initializer
     """
-    Parallelize() allows for the parallelization of for-loop when processing data. 
-    
+    return globals().get("__48162789685__")
+
+
+def _create_shared_array(shape, dtype):
+    """
+    Allocate a shared memory block and return it together with a NumPy array viewing it. The caller is responsible for
+    closing and unlinking the block once the array is no longer needed
+
+    :param shape: (tuple) required: shape of the array
+    :param dtype: (numpy dtype) required: dtype of the array
+    :return: (SharedMemory, ndarray)
+    """
+    dtype = np.dtype(dtype)
+    nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    shm = _shared_memory.SharedMemory(create=True, size=nbytes)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+class ParallelExecutor():
+    def __init__(self, num_cores=None, start_method=None, initializer=None, initargs=()):
+        """
+        ParallelExecutor keeps a pool of warm workers that can be reused by many calls to Parallelize() and imap(), so the
+        pool startup (and any per-worker state) is only paid once, e.g. across the iterations of a notebook loop.
+        Use it as a context manager, or call close() when done.
+
+        Constructor parameters:
+        ----------------
+        :param num_cores: (integer) optional: The desired number of cores to allocate. If unspecified, the maximum possible will be used
+        :param start_method: (string) optional: The multiprocessing start method to use ("fork", "spawn" or "forkserver")
+        :param initializer: (function) optional: Called once in every worker with initargs. Its return value is available to f
+                            through worker_state(). Default = None
+        :param initargs: (tuple) optional: The arguments passed to initializer. Default = ()
+
+        Example:
+        ----------------
+        >>> def load_mask(path):
+        >>>     return nb.load(path)
+        >>> def get_amygdala_data(single):
+        >>>     return masking.apply_mask(masking.unmask(single, old_mask), worker_state())
+        >>> with ParallelExecutor(100, initializer=load_mask, initargs=(CC_mask,)) as executor:
+        >>>     for pc_stack in pc_stacks:
+        >>>         processed = executor.map(pc_stack, get_amygdala_data)
+        """
+        if(num_cores == None):
+            num_cores = multiprocessing.cpu_count()
+        self.num_cores = min(num_cores, multiprocessing.cpu_count())
+
+        ctx = multiprocessing.get_context(start_method)
+        self.start_method = ctx.get_start_method()
+        self._pool = _start_executor_pool(ctx, self.num_cores, initializer, initargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def map(self, data, f, chunksize=None, shared_memory=False):
+        """
+        Run Parallelize() on the workers of this executor. See Parallelize() for the parameters and the returned array
+        """
+        return Parallelize(data, f, shared_memory=shared_memory, chunksize=chunksize, executor=self)
+
+    def imap(self, data, f, chunksize=1, max_pending=None):
+        """
+        Run imap() on the workers of this executor. See imap() for the parameters and the returned generator
+        """
+        if(max_pending == None):
+            max_pending = 2 * self.num_cores
+        return _imap(self._pool, data, f, chunksize, max_pending)
+
+    def close(self):
+        """
+        Let the workers finish their current tasks and shut them down
+        """
+        self._pool.close()
+        self._pool.join()
+
+
+def _start_executor_pool(ctx, num_cores, initializer, initargs):
+    """
+    Start the pool of a ParallelExecutor. Kept outside of the class so that the module level helpers are not name mangled
+
+    :param ctx: (multiprocessing context) required: The context used to start the workers
+    :param num_cores: (integer) required: The number of workers
+    :param initializer: (function) required: The user initializer, or None
+    :param initargs: (tuple) required: The arguments passed to initializer
+    :return: multiprocessing.pool.Pool
+    """
+    return ctx.Pool(num_cores, initializer=__run_initializer, initargs=(initializer, initargs))
+
+
+def Parallelize(data, f, num_cores=None, shared_memory=False, start_method=None, chunksize=None, executor=None, backend="process",
+                out=None, ragged=None, profile=False, callback=None, errors="raise", retries=0, checkpoint=None, dtype=None,
+                checkpoint_key=None):
+    """
+    Parallelize() allows for the parallelization of for-loop when processing data.
+
     Parameters:
     ----------------
     :param data: (Python array or Numpy array) required: the sequence of data to be processed
     :param f: (a function) required: A function that takes in an element of data and returns the desired processed output of that element
     :param num_cores: (integer) optional: The desired number of cores to allocate. If unspecified, the maximum possible will be used
-    
-    
+    :param shared_memory: (bool) optional: If True, data is copied once into a multiprocessing.shared_memory block and the workers
+                          write their outputs straight into a preallocated shared output array instead of pickling them back.
+                          The output array is sized from the outputs of the first chunk. Default = False
+    :param start_method: (string) optional: The multiprocessing start method to use ("fork", "spawn" or "forkserver"). If unspecified,
+                         the platform default is used. With "spawn" and "forkserver", f must be importable by the workers
+    :param chunksize: (integer) optional: The number of consecutive elements handed to a worker at once. Workers pull a new chunk
+                      whenever they finish one, so smaller chunks balance uneven workloads better at the cost of more scheduling.
+                      If unspecified, every core gets about 4 chunks
+    :param executor: (ParallelExecutor) optional: Run on the warm workers of this executor instead of starting a new pool.
+                     num_cores and start_method are then taken from the executor
+    :param backend: (string) optional: How the chunks are run. Default = "process"
+                    "process": in a pool of worker processes
+                    "thread": in a pool of threads, without copying or pickling anything. Best when f releases the GIL (most NumPy/nibabel calls)
+                    "batch": in a pool of threads, but f receives a 2-D block of rows (one chunk) and must return a block with one row per input row
+                    "auto": f is timed on the first few elements, then "thread" is used if it runs in parallel on threads or if the whole run is
+                            too short to be worth starting processes, and "process" otherwise. The probed outputs are kept, not recomputed
+    :param out: (Numpy array, np.memmap or path) optional: Where the outputs are written, instead of a newly allocated array.
+                An array must have the shape (number of elements to process, output size). A path is created as a .npy file
+                (readable later with np.load(path, mmap_mode="r")) sized from the outputs of the first chunk. Worker processes write
+                directly into np.memmap outputs, and threads into any array, so the results never have to fit in memory at once.
+                With ragged="offsets", a path receives the concatenated values instead. Default = None
+    :param ragged: (string) optional: How to return outputs of different sizes or types. Default = None
+                   None: a single array of shape (number of elements to process, -1); every output must have the same size
+                   "list": a list holding the output of f for every element, as returned by f
+                   "offsets": a tuple (values, offsets) where values is the 1-D concatenation of the flattened outputs and the
+                              output of element i is values[offsets[i]:offsets[i + 1]]
+    :param profile: (bool) optional: If True, every element is timed in the workers, the outputs are pickled explicitly to measure the
+                    serialization time, and a ParallelStats summary is returned next to the results. Default = False
+    :param callback: (function) optional: Called in the parent process with the live ParallelStats after every finished chunk, e.g. to
+                     update a progress bar. Only progress and throughput are tracked unless profile is True. Default = None
+    :param errors: (string) optional: What to do when f raises for an element. Default = "raise"
+                   "raise": the exception is raised in the parent process and the run stops
+                   "return": the run goes on, and a dict {index: ElementError} of the failed elements is returned next to the results.
+                             Failed rows are filled with nan (0 for non-float outputs), empty with ragged="offsets", and hold the
+                             ElementError itself with ragged="list"
+    :param retries: (int) optional: Number of extra attempts for an element whose f call raised, before errors applies. Default = 0
+    :param checkpoint: (path) optional: A directory where the outputs of every finished chunk are saved. If it already holds the
+                       checkpoint of an interrupted run of the same f on data of the same length, shape and type (a ValueError
+                       is raised otherwise), those outputs are loaded and only the missing
+                       (or failed) elements are computed. The outputs are then returned by the workers instead of written in place.
+                       f is recognized by its name, with the arguments of a functools.partial and the pickled state of a callable
+                       object. Lambdas and nested functions have no such name and need checkpoint_key. Default = None
+    :param dtype: (numpy dtype) optional: The type of the result array (of the values with ragged="offsets"), e.g. np.float32 when
+                  f computes in float64 but the results are stored in float32. The outputs are cast as they are written, so
+                  no array of the results is ever allocated in another type. Default = None, the type of out if given,
+                  else the common type of all outputs (e.g. floats after ints give floats). When the workers write into
+                  shared memory or a memmap, or with backend="thread", that is the type of the first chunk instead, and later
+                  outputs that cannot be cast to it without loss then raise a ValueError
+    :param checkpoint_key: (string) optional: Identifies f in the checkpoint instead of its name, e.g. for a lambda, or to resume
+                           with a fixed version of f. Default = None
+
+
     Returns:
     ----------------
-    Returns a NumPy array of shape (number of elements to process, -1) where -1 depends on the user-chosen function f
+    Returns a NumPy array of shape (number of elements to process, -1) where -1 depends on the user-chosen function f, out if it was
+    given (a np.memmap if out was a path), or the list / (values, offsets) tuple described by ragged.
+    If profile is True, returns (results, ParallelStats). If errors is "return", the dict of failed elements is appended, i.e.
+    (results, failures) or (results, ParallelStats, failures)
+
+    Example:
+    ----------------
+    >>> bar = tqdm(total=len(pc_stack))
+    >>> processed, stats = Parallelize(pc_stack, get_amygdala_data, 100, profile=True, callback=lambda s: bar.update(s.done - bar.n))
+    >>> print(stats)
     """
-    
+
     #Get the number of "subjects" i.e. the length of the data
     num_subjects = len(data)
-    if(num_cores == None): #If the number of cores in unspecified, get the maximum number of cores available
+    if(executor != None):
+        num_cores = executor.num_cores
+    elif(num_cores == None): #If the number of cores in unspecified, get the maximum number of cores available
         num_cores = multiprocessing.cpu_count()
-    
+
     #The number of cores we use cannot exceed the number of subjects there are
     num_cores = min(num_cores, num_subjects, multiprocessing.cpu_count())
-    
-    
-    #Creating a dictionary that has the core indices as keys and ranges of data element indices as the values
-    cores_to_use = num_cores - 1
-    range_dict = {}
-    for i in range(cores_to_use):
-        range_dict[i] = np.arange(i*int(num_subjects/(cores_to_use)), (i+1)*int(num_subjects/(cores_to_use)))
-    range_dict[cores_to_use] = np.arange(num_subjects - num_subjects%cores_to_use, num_subjects)
-    
-    #Checking that there is an entry of the dictionary for every core that we will use
-    assert(num_cores == len(range_dict))
-    
-    #Creating a list of tuples. Each tuple will serve as the arguments passed to the __processor_procedure helper function
-    pass_data = []
-    
-    for core_index in range(num_cores):
-        pass_data.append((core_index, range_dict, f))
-    
-    #Create a global variable and copy the data to it. The variable name was chosen in a way such that it hopefully would not
-    #overwrite a user-defined variable. By creating such a global variable, each of the helper functions can easily access the
-    #data without having it explicitly passed to them, which would waste time and resources
-    global __48162789682__
-    __48162789682__ = data
-    
-    #Initialize a pool of workers. 
-    with Pool(num_cores) as p:
-        _returns = p.starmap(__processor_procedure, pass_data)
-    
-    #Delete the global variable that we defined
-    del __48162789682__
-    
-    #Process the _returns dictionary into a NumPy array
-    final_dict = {}
-    for d in _returns:
-        final_dict = {**final_dict, **d}
-    
-    return np.array(list(final_dict.values())).reshape(len(data),-1)
+
+    if backend not in _BACKENDS:
+        raise ValueError(f"backend must be one of {_BACKENDS}, got {backend!r}")
+    if ragged not in _RAGGED:
+        raise ValueError(f"ragged must be one of {_RAGGED}, got {ragged!r}")
+    if(executor != None and backend not in ("process", "auto")):
+        raise ValueError("an executor can only be used with backend='process'")
+    if(ragged == "list" and out is not None):
+        raise ValueError("out cannot be used with ragged='list'")
+    if errors not in ("raise", "return"):
+        raise ValueError(f"errors must be 'raise' or 'return', got {errors!r}")
+
+    if(profile or callback != None):
+        stats = ParallelStats(num_subjects, num_cores, callback)
+    else:
+        stats = None
+
+    #Elements already finished by an interrupted run are loaded instead of computed again
+    todo = np.arange(num_subjects)
+    if(checkpoint != None):
+        resumed = _load_checkpoint(checkpoint, f, data, checkpoint_key)
+        todo = np.setdiff1d(todo, np.fromiter(resumed, dtype=int, count=len(resumed)))
+
+    #The outputs of the "auto" probe are kept as the first elements of the result
+    probed = []
+    if backend == "auto":
+        backend, probed = _auto_probe(data, f, num_cores, executor, todo, errors, retries)
+        todo = todo[len(probed):]
+    if stats is not None:
+        stats.backend = backend
+
+    if backend in ("thread", "batch"):
+        sink_kind = "thread"
+    elif shared_memory:
+        sink_kind = "shared"
+    else:
+        sink_kind = "process"
+
+    #Split the data element indices into contiguous chunks. The chunks are handed out to the workers as they become idle,
+    #so a core that got cheap elements simply takes more chunks instead of waiting for the slowest core
+    if(chunksize == None):
+        chunksize = max(1, int(np.ceil(num_subjects / (4 * num_cores))))
+    chunks = _make_chunks(todo, chunksize)
+
+    with _ResultAssembler(num_subjects, out, ragged, sink_kind, stats, checkpoint, dtype) as assembler:
+        if(checkpoint != None and resumed):
+            for chunk, outputs in _runs_of(resumed):
+                assembler.collect(chunk, outputs, None, None, save=False)
+        for index, output in probed:
+            assembler.collect(range(index, index + 1), [output], None, _failures(range(index, index + 1), [output]))
+
+        ctx = multiprocessing.get_context(start_method)
+
+        #The options every worker needs besides its chunk
+        options = (profile, errors, retries, assembler.casting)
+
+        if not chunks: #everything was already loaded from the checkpoint or processed by the "auto" probe
+            pass
+
+        elif backend in ("thread", "batch"):
+            _run_threads(data, f, num_cores, chunks, backend == "batch", assembler, options)
+
+        elif shared_memory:
+            #Copy the input once into shared memory, the workers only receive the name of the block
+            data = np.asarray(data)
+            shm_in, shared_in = _create_shared_array(data.shape, data.dtype)
+            try:
+                shared_in[...] = data
+                in_spec = ("shm", shm_in.name, shared_in.shape, shared_in.dtype.str)
+                del shared_in
+
+                if(executor != None):
+                    _run_pool(executor._pool, f, chunks, lambda chunk: in_spec, assembler, options)
+                else:
+                    with ctx.Pool(num_cores) as p:
+                        _run_pool(p, f, chunks, lambda chunk: in_spec, assembler, options)
+            finally:
+                _close_shared(shm_in, unlink=True)
+
+        elif(executor != None):
+            #The workers of a running pool cannot see the global variable, so the elements are sent together with their chunk
+            _run_pool(executor._pool, f, chunks, lambda chunk: ("rows", data[chunk.start:chunk.stop]), assembler, options)
+
+        else:
+            #Create a global variable and copy the data to it. The variable name was chosen in a way such that it hopefully would not
+            #overwrite a user-defined variable. By creating such a global variable, each of the helper functions can easily access the
+            #data without having it explicitly passed to them, which would waste time and resources
+            global __48162789682__
+            __48162789682__ = data
+
+            #Workers that are not forked do not inherit the global variable, so it is set by an initializer instead
+            if ctx.get_start_method() == "fork":
+                initializer, initargs = None, ()
+            else:
+                initializer, initargs = __set_global_data, (data,)
+
+            #Initialize a pool of workers.
+            try:
+                with ctx.Pool(num_cores, initializer=initializer, initargs=initargs) as p:
+                    _run_pool(p, f, chunks, lambda chunk: None, assembler, options)
+            finally:
+                #Delete the global variable that we defined
+                del __48162789682__
+
+        returned = (assembler.result(),)
+
+    if profile:
+        returned += (stats,)
+    if errors == "return":
+        returned += (assembler.failures,)
+    return returned if len(returned) > 1 else returned[0]
+
+
+def _make_chunks(todo, chunksize):
+    """
+    Split the sorted element indices todo into ranges of at most chunksize consecutive indices
+
+    :param todo: (ndarray) required: sorted indices of the elements to process
+    :param chunksize: (integer) required: the maximum number of elements per chunk
+    :return: list of ranges
+    """
+    chunks = []
+    #A new run of consecutive indices starts wherever two neighbours differ by more than one
+    starts = np.flatnonzero(np.diff(todo) != 1) + 1
+    for run in np.split(todo, starts):
+        if len(run) == 0:
+            continue
+        for start in range(run[0], run[-1] + 1, chunksize):
+            chunks.append(range(start, min(start + chunksize, run[-1] + 1)))
+    return chunks
+
+
+def _run_pool(pool, f, chunks, source_of, assembler, options):
+    """
+    Run the chunks on a pool of worker processes and hand their outputs to the assembler as they finish
+
+    :param pool: (multiprocessing.pool.Pool) required: The pool running the chunks
+    :param f: (function) required: The function that the elements will be passed to
+    :param chunks: (list) required: The ranges of element indices to process
+    :param source_of: (function) required: Returns the source argument of __processor_procedure() for a chunk
+    :param assembler: (_ResultAssembler) required: Collects the outputs
+    :param options: (tuple) required: The profile, errors, retries and casting arguments of __processor_procedure()
+    """
+    #The layout of the output is only known once some outputs exist, so the first chunks are run on their own when the
+    #workers are to write into a sink of that layout
+    while chunks and assembler.waits_for_sink:
+        first, chunks = chunks[0], chunks[1:]
+        assembler.submitted(1)
+        assembler.collect(*pool.apply(__processor_procedure, (first, f, source_of(first), None) + options))
+
+    def tasks():
+        for chunk in chunks:
+            assembler.submitted(1)
+            yield (chunk, f, source_of(chunk), assembler.sink) + options
+
+    #chunksize=1 because every task already is a chunk of elements
+    for returned in pool.imap_unordered(__star_processor_procedure, tasks(), chunksize=1):
+        assembler.collect(*returned)
+
+
+def _run_threads(data, f, num_cores, chunks, batch, assembler, options):
+    """
+    Helper function for Parallelize(backend="thread") and Parallelize(backend="batch"). The chunks are run on a pool of
+    threads that read data and write the outputs directly, so nothing is copied or pickled
+
+    Parameters:
+    ----------------
+    :param data: (Python array or Numpy array) required: the sequence of data to be processed
+    :param f: (function) required: The function that the elements (or blocks of rows if batch) will be passed to
+    :param num_cores: (integer) required: The number of threads to start
+    :param chunks: (list) required: The ranges of element indices handed out to the threads
+    :param batch: (bool) required: If True, f is called once per chunk on the 2-D block of rows of that chunk
+    :param assembler: (_ResultAssembler) required: Collects the outputs
+    :param options: (tuple) required: The profile, errors, retries and casting arguments of __processor_procedure()
+    """
+    profile, errors, retries, casting = options
+    guarded = errors != "raise" or retries > 0
+    if batch:
+        data = np.asarray(data)
+
+    def run_block(block):
+        outputs = np.asarray(f(block))
+        if(len(outputs) != len(block)):
+            raise ValueError(f"with backend='batch', f must return one row per input row, got {len(outputs)} rows for {len(block)}")
+        return outputs
+
+    def run_chunk(chunk, sink):
+        report = _new_report(threading.get_ident()) if profile else None
+        start = time.perf_counter()
+        if batch:
+            run = _guarded(run_block, errors, retries) if guarded else run_block
+            outputs = run(data[chunk.start:chunk.stop])
+            if isinstance(outputs, ElementError): #the whole block failed, so every element in it did
+                outputs = [ElementError(None, outputs.error, outputs.traceback_text) for index in chunk]
+            if profile: #the elements of a block are processed together, so they share its time
+                report["item_times"] = [(time.perf_counter() - start) / len(chunk)] * len(chunk)
+        else:
+            run = _guarded(f, errors, retries) if guarded else f
+            if profile:
+                run = _timed(run, report["item_times"])
+            outputs = [run(data[index]) for index in chunk]
+        failures = _failures(chunk, outputs) if guarded else None
+
+        if sink is not None and failures is None:
+            _write_rows(sink, slice(chunk.start, chunk.stop), np.reshape(outputs, (len(chunk), -1)), casting)
+            outputs = None
+        if profile:
+            report["max_rss"] = _max_rss()
+        return chunk, outputs, report, failures
+
+    while chunks and assembler.waits_for_sink:
+        first, chunks = chunks[0], chunks[1:]
+        assembler.submitted(1)
+        assembler.collect(*run_chunk(first, None))
+
+    with ThreadPoolExecutor(num_cores) as pool:
+        futures = [pool.submit(run_chunk, chunk, assembler.sink) for chunk in chunks]
+        assembler.submitted(len(futures))
+        for future in as_completed(futures):
+            assembler.collect(*future.result())
+
+
+def _auto_probe(data, f, num_cores, executor, todo, errors, retries):
+    """
+    Helper function for Parallelize(backend="auto"). f is run on the first _AUTO_PROBE_SIZE elements of todo serially, and
+    on the next _AUTO_PROBE_SIZE elements with one thread each. Threads are chosen for the rest of the data if they ran
+    faster than the serial loop (f releases the GIL), or if the whole serial run would be shorter than _AUTO_MIN_PROCESS_TIME.
+    Otherwise the rest of the data goes to worker processes. Processes are always used with an executor
+
+    Parameters:
+    ----------------
+    See Parallelize(). todo holds the indices of the elements still to process
+
+    Returns:
+    ----------------
+    (backend, probed) where probed is the list of (index, output) of the probed elements
+    """
+    if(errors != "raise" or retries > 0):
+        f = _guarded(f, errors, retries)
+    num_probe = min(_AUTO_PROBE_SIZE, len(todo))
+
+    start = time.perf_counter()
+    probed = [(index, f(data[index])) for index in todo[:num_probe]]
+    serial_time = time.perf_counter() - start
+
+    threads_scale = False
+    if(num_cores > 1 and len(todo) >= 2 * num_probe):
+        with ThreadPoolExecutor(num_probe) as pool:
+            start = time.perf_counter()
+            probed += list(pool.map(lambda index: (index, f(data[index])), todo[num_probe:2 * num_probe]))
+            threaded_time = time.perf_counter() - start
+        threads_scale = threaded_time < 0.6 * serial_time
+
+    estimated_time = serial_time / max(num_probe, 1) * len(todo)
+    if(executor == None and (num_cores == 1 or threads_scale or estimated_time < _AUTO_MIN_PROCESS_TIME)):
+        return "thread", probed
+    return "process", probed
+
+
+def _checkpoint_fingerprint(f, data, checkpoint_key=None):
+    """
+    Describe a Parallelize() run by the number of elements, the function and the shape / type of the data, so that a
+    checkpoint is never resumed by a run whose outputs would differ
+    """
+    function = checkpoint_key if checkpoint_key != None else _function_key(f)
+    if function is None:
+        raise ValueError(f"{f!r} has no stable name to recognize it in a checkpoint, define it at module level or pass checkpoint_key")
+    shape = getattr(data, "shape", None)
+    return {"num_subjects": len(data),
+            "function": function,
+            "shape": None if shape is None else list(shape),
+            "dtype": str(data.dtype) if hasattr(data, "dtype") else None}
+
+
+def _function_key(f):
+    """
+    Return a string that names f across runs: module and qualname of a function, followed by a digest of the arguments of
+    a functools.partial or of the pickled state of a callable object. None for lambdas, nested functions and callables
+    that cannot be pickled, whose name says nothing about what they compute
+    """
+    if isinstance(f, functools.partial):
+        inner = _function_key(f.func)
+        return None if inner is None else f"{inner}({_digest((f.args, f.keywords))})"
+    if isinstance(f, (types.FunctionType, types.BuiltinFunctionType)):
+        return None if "<" in f.__qualname__ else f"{f.__module__}.{f.__qualname__}"
+    try:
+        return f"{type(f).__module__}.{type(f).__qualname__}({_digest(f)})"
+    except Exception: #e.g. a bound method of a local class
+        return None
+
+
+def _digest(obj):
+    """
+    Return a short hash of the pickle of obj
+    """
+    return hashlib.sha256(pickle.dumps(obj, protocol=4)).hexdigest()[:16]
+
+
+def _load_checkpoint(path, f, data, checkpoint_key=None):
+    """
+    Load the outputs saved in a checkpoint directory by an earlier Parallelize() run, creating the directory if needed
+
+    :param path: (path) required: the checkpoint directory
+    :param f: (function) required: the function of the current run, which must match the checkpoint
+    :param data: (NumPy array, list, ...) required: the data of the current run, whose length, shape and type must match the checkpoint
+    :param checkpoint_key: (string) optional: names f in the checkpoint instead of _function_key(f)
+    :return: dict {index: output} of the finished elements
+    """
+    os.makedirs(path, exist_ok=True)
+    manifest = os.path.join(path, "checkpoint.json")
+    fingerprint = _checkpoint_fingerprint(f, data, checkpoint_key)
+    if os.path.exists(manifest):
+        with open(manifest) as fh:
+            saved = json.load(fh)
+        #checkpoints of older versions only record the number of elements
+        for key, value in saved.items():
+            if(key in fingerprint and fingerprint[key] != value):
+                raise ValueError(f"the checkpoint in {path} was made for {key} {value}, not {fingerprint[key]}")
+    else:
+        with open(manifest, "w") as fh:
+            json.dump(fingerprint, fh)
+
+    resumed = {}
+    for name in sorted(os.listdir(path)):
+        if name.startswith("chunk_") and name.endswith(".pkl"):
+            with open(os.path.join(path, name), "rb") as fh:
+                resumed.update(pickle.load(fh))
+    return resumed
+
+
+def _save_checkpoint(path, chunk, outputs):
+    """
+    Save the successful outputs of a finished chunk in the checkpoint directory. The file is written under a temporary
+    name and then renamed, so a run killed while saving never leaves a truncated checkpoint behind
+
+    :param path: (path) required: the checkpoint directory
+    :param chunk: (range) required: the indices of the elements of the chunk
+    :param outputs: (list) required: the outputs of the chunk
+    """
+    finished = {index: output for index, output in zip(chunk, outputs) if not isinstance(output, ElementError)}
+    if not finished:
+        return
+    name = os.path.join(path, f"chunk_{chunk.start:012d}_{chunk.stop:012d}.pkl")
+    with open(name + ".tmp", "wb") as fh:
+        pickle.dump(finished, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(name + ".tmp", name)
+
+
+def _runs_of(resumed):
+    """
+    Group the {index: output} loaded from a checkpoint into (range, outputs) runs of consecutive indices
+    """
+    indices = np.array(sorted(resumed))
+    starts = np.flatnonzero(np.diff(indices) != 1) + 1
+    for run in np.split(indices, starts):
+        yield range(run[0], run[-1] + 1), [resumed[index] for index in run]
+
+
+class ParallelStats():
+    def __init__(self, total, num_cores, callback=None):
+        """
+        ParallelStats tracks the progress of one Parallelize() call. It is passed to the callback of Parallelize() after every
+        finished chunk and returned next to the results by Parallelize(profile=True). Per-element, per-worker and
+        serialization timings are only filled in when profiling. print() it for a summary.
+
+        Constructor parameters:
+        ----------------
+        :param total: (int), required: The number of elements to process
+        :param num_cores: (int), required: The number of workers
+        :param callback: (function), optional: Called with this object after every finished chunk. Default = None
+
+        Attributes:
+        ----------------
+        done: number of elements finished so far, out of total
+        elapsed: seconds since the start of the run
+        items_per_sec: throughput so far
+        submitted, queue_depth, max_queue_depth: chunks handed to the workers, chunks handed out but not finished (now and at most)
+        item_times: (ndarray) compute time of f in seconds for every element, nan where not measured
+        workers: (dict) per worker (pid, or thread id for the thread backends): number of chunks and items, compute time,
+                 serialization time and memory high-water mark in bytes
+        compute_time: total time spent in f, summed over the workers
+        serialization_time: time spent pickling the outputs in the workers
+        deserialization_time: time spent unpickling the outputs in the parent process
+        max_rss: largest memory high-water mark of the workers in bytes
+        """
+        self.total = total
+        self.num_cores = num_cores
+        self.callback = callback
+        self.backend = None
+
+        self.done = 0
+        self.submitted = 0
+        self.max_queue_depth = 0
+        self.item_times = np.full(total, np.nan)
+        self.workers = {}
+        self.serialization_time = 0.0
+        self.deserialization_time = 0.0
+        self._chunks_done = 0
+        self._start = time.perf_counter()
+        self._end = None
+
+    @property
+    def elapsed(self):
+        end = self._end if self._end is not None else time.perf_counter()
+        return end - self._start
+
+    @property
+    def items_per_sec(self):
+        return self.done / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def queue_depth(self):
+        return self.submitted - self._chunks_done
+
+    @property
+    def compute_time(self):
+        return float(np.nansum(self.item_times))
+
+    @property
+    def max_rss(self):
+        rss = [worker["max_rss"] for worker in self.workers.values() if worker["max_rss"] is not None]
+        return max(rss) if rss else None
+
+    def record(self, chunk, outputs, report):
+        """
+        Add a finished chunk. Returns its outputs, unpickled if the worker pickled them for timing
+        """
+        if report is not None:
+            if isinstance(outputs, bytes):
+                start = time.perf_counter()
+                outputs = pickle.loads(outputs)
+                self.deserialization_time += time.perf_counter() - start
+
+            item_times = report["item_times"]
+            self.item_times[chunk.start:chunk.start + len(item_times)] = item_times
+            self.serialization_time += report["serialization_time"]
+
+            worker = self.workers.setdefault(report["worker"], {"chunks": 0, "items": 0, "compute_time": 0.0,
+                                                                "serialization_time": 0.0, "max_rss": None})
+            worker["chunks"] += 1
+            worker["items"] += len(chunk)
+            worker["compute_time"] += sum(item_times)
+            worker["serialization_time"] += report["serialization_time"]
+            if report["max_rss"] is not None:
+                worker["max_rss"] = max(worker["max_rss"] or 0, report["max_rss"])
+
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        self._chunks_done += 1
+        self.done += len(chunk)
+        if self.done == self.total:
+            self._end = time.perf_counter()
+        return outputs
+
+    def __repr__(self):
+        lines = [f"ParallelStats: {self.done}/{self.total} elements in {self.elapsed:.3f} s ({self.items_per_sec:.1f} elements/s)"
+                 f" on {self.num_cores} cores, backend {self.backend!r}",
+                 f"    max queue depth: {self.max_queue_depth} chunks"]
+        if self.workers:
+            timed = self.item_times[~np.isnan(self.item_times)]
+            lines.append(f"    compute: {self.compute_time:.3f} s total, {timed.mean():.2e} s mean, {timed.max():.2e} s max per element")
+            lines.append(f"    serialization: {self.serialization_time:.3f} s in the workers, {self.deserialization_time:.3f} s in the parent")
+            if self.max_rss is not None:
+                lines.append(f"    worker memory high-water mark: {self.max_rss / 2**20:.1f} MiB")
+            for name, worker in self.workers.items():
+                lines.append(f"    worker {name}: {worker['items']} elements in {worker['chunks']} chunks, {worker['compute_time']:.3f} s compute")
+        return "\n".join(lines)
+
+
+class _ResultAssembler():
+    def __init__(self, num_subjects, out, ragged, sink_kind, stats=None, checkpoint=None, dtype=None):
+        """
+        _ResultAssembler collects the outputs of the chunks, which can arrive in any order, into the container returned by
+        Parallelize(). The outputs are written in place as they arrive, so no intermediate copy of all results is kept.
+        Once the first outputs are in, sink tells the workers where they can write the following ones themselves.
+
+        Constructor parameters:
+        ----------------
+        :param num_subjects: (int), required: The number of elements processed
+        :param out: (Numpy array, np.memmap, path or None), required: The out parameter of Parallelize()
+        :param ragged: (string), required: The ragged parameter of Parallelize()
+        :param sink_kind: (string), required: "process", "shared" (processes writing into shared memory) or "thread"
+        :param stats: (ParallelStats), optional: Receives the progress and timings of every chunk. Default = None
+        :param checkpoint: (path), optional: The checkpoint directory of Parallelize(). The workers then always return their
+                           outputs so that they can be saved. Default = None
+        :param dtype: (numpy dtype), optional: The dtype parameter of Parallelize(). Default = None
+        """
+        self.num_subjects = num_subjects
+        self.out = out
+        self.ragged = ragged
+        self.sink_kind = sink_kind
+        self.stats = stats
+        self.checkpoint = checkpoint
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        #Outputs are only cast to a type that cannot hold them when it was asked for
+        self.casting = "same_kind" if dtype is None else "unsafe"
+
+        self.ready = ragged is not None
+        self.sink = None
+        self.promotes = False
+        self.target = None
+        self.failures = {}
+        self._shm = None
+
+        if ragged == "list":
+            self.processed = [None] * num_subjects
+        elif ragged == "offsets":
+            #Outputs are appended to the values in order, chunks that arrive early wait in _pending
+            self.offsets = np.zeros(num_subjects + 1, dtype=np.int64)
+            self._pending = {}
+            self._next = 0
+            self._values = []
+            self._dtype = self.dtype
+            self._file = open(out, "wb") if out is not None else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self._shm is not None:
+            _close_shared(self._shm, unlink=True)
+        if self.ragged == "offsets" and self._file is not None:
+            self._file.close()
+
+    def submitted(self, num_chunks):
+        """
+        Count chunks handed to the workers, for the queue depth of ParallelStats
+        """
+        if self.stats is not None:
+            self.stats.submitted += num_chunks
+
+    def collect(self, chunk, outputs, report, failures, save=True):
+        """
+        Handle a finished chunk, as returned by __processor_procedure(): record its timings, save it in the checkpoint,
+        store its outputs and call the progress callback
+        """
+        if self.stats is not None:
+            outputs = self.stats.record(chunk, outputs, report)
+        if failures is not None:
+            self.failures.update((failure.index, failure) for failure in failures)
+        if(save and self.checkpoint != None):
+            _save_checkpoint(self.checkpoint, chunk, outputs)
+        self.add(chunk, outputs)
+        if self.stats is not None and self.stats.callback != None:
+            self.stats.callback(self.stats)
+
+    def add(self, chunk, outputs):
+        """
+        Store the outputs of the elements in chunk. outputs is None when a worker already wrote them into the sink
+        """
+        if outputs is None:
+            return
+        if self.ragged == "list":
+            self.processed[chunk.start:chunk.stop] = list(outputs)
+        elif self.ragged == "offsets":
+            self._pending[chunk.start] = (chunk, outputs)
+            self._append_ready()
+        elif any(isinstance(output, ElementError) for output in outputs):
+            #Failed elements leave their row to be filled by result()
+            for index, output in zip(chunk, outputs):
+                if not isinstance(output, ElementError):
+                    self.add(range(index, index + 1), [output])
+        else:
+            block = np.reshape(np.asarray(outputs, dtype=self.dtype), (len(chunk), -1))
+            if not self.ready:
+                self._allocate(block.shape[1], block.dtype)
+            if(self.promotes and not np.can_cast(block.dtype, self.target.dtype, "safe")):
+                #e.g. floats after ints: the rows already written are copied into a result of the common type
+                self.target = self.target.astype(np.result_type(self.target, block))
+            _write_rows(self.target, slice(chunk.start, chunk.stop), block, self.casting)
+
+    @property
+    def waits_for_sink(self):
+        """
+        True if the workers will write into a sink once the first outputs are in, so the first chunk is worth running on
+        its own. Otherwise every chunk can be submitted at once, and the result is sized by whichever finishes first
+        """
+        if(self.ready or self.checkpoint != None):
+            return False
+        return self.sink_kind in ("shared", "thread") or isinstance(self.out, (str, os.PathLike, np.memmap))
+
+    def _allocate(self, size, dtype):
+        """
+        Create (or check) the output array and the sink once the size and dtype of the outputs are known
+        """
+        shape = (self.num_subjects, size)
+        out = self.out
+        if isinstance(out, (str, os.PathLike)):
+            out = np.lib.format.open_memmap(os.fspath(out), mode="w+", dtype=dtype, shape=shape)
+        elif out is not None:
+            if(out.shape != shape):
+                raise ValueError(f"out has shape {out.shape}, but the outputs need {shape}")
+        elif(self.sink_kind == "shared" and self.checkpoint == None):
+            self._shm, out = _create_shared_array(shape, dtype)
+            self.sink = ("shm", self._shm.name, shape, out.dtype.str)
+        else:
+            out = np.empty(shape, dtype=dtype)
+
+        if(self.checkpoint != None):
+            pass #the outputs have to come back to the parent process to be saved
+        elif self.sink_kind == "thread":
+            self.sink = out
+        elif isinstance(out, np.memmap) and isinstance(out.base, mmap.mmap) and out.flags.c_contiguous:
+            #Only a memmap that maps its whole file region (not a slice of one) can be reopened from its filename and offset
+            self.sink = ("memmap", out.filename, out.shape, out.dtype.str, out.offset)
+
+        #Only a result that no one else sees can be reallocated in a wider type when later outputs need it
+        self.promotes = self.out is None and self.dtype is None and self.sink is None
+        self.target = out
+        self.ready = True
+
+    def _append_ready(self):
+        """
+        Append the outputs of the waiting chunks that are next in order to the values of ragged="offsets"
+        """
+        while self._next in self._pending:
+            chunk, outputs = self._pending.pop(self._next)
+            for index, output in zip(chunk, outputs):
+                if isinstance(output, ElementError): #failed elements get an empty segment
+                    self.offsets[index + 1] = self.offsets[index]
+                    continue
+                values = np.ravel(output)
+                if self._dtype is None:
+                    self._dtype = values.dtype
+                values = values.astype(self._dtype, copy=False)
+                self.offsets[index + 1] = self.offsets[index] + values.size
+                if self._file is not None:
+                    self._file.write(values.tobytes())
+                else:
+                    self._values.append(values)
+            self._next = chunk.stop
+
+    def result(self):
+        """
+        Return the assembled outputs in the layout requested from Parallelize()
+        """
+        if self.ragged == "list":
+            return self.processed
+        if self.ragged == "offsets":
+            dtype = self._dtype if self._dtype is not None else np.float64
+            if self._file is None:
+                return (np.concatenate(self._values) if self._values else np.empty(0, dtype=dtype)), self.offsets
+            self._file.close()
+            if(self.offsets[-1] == 0):
+                return np.empty(0, dtype=dtype), self.offsets
+            return np.memmap(self.out, dtype=dtype, mode="r", shape=(int(self.offsets[-1]),)), self.offsets
+
+        if not self.ready: #every element failed, so the size of the outputs is unknown
+            return np.full((self.num_subjects, 0), np.nan, dtype=self.dtype)
+        if self.failures:
+            failed = sorted(self.failures)
+            self.target[failed] = np.nan if np.issubdtype(self.target.dtype, np.inexact) else 0
+        if self._shm is not None:
+            #Copy the result out of the shared block before it is released
+            return np.array(self.target)
+        return self.target
+
+
+def _iter_chunks(data, chunksize):
+    """
+    Split data into consecutive chunks of at most chunksize elements without materializing it. NumPy arrays (including
+    np.memmap) are sliced, so only the rows of the current chunk are read; any other iterable is consumed lazily
+
+    :param data: (iterable, Numpy array or np.memmap) required: the sequence of data to be processed
+    :param chunksize: (integer) required: the number of elements per chunk
+    :return: generator of chunks
+    """
+    if isinstance(data, np.ndarray):
+        for start in range(0, len(data), chunksize):
+            yield data[start:start + chunksize]
+    else:
+        iterator = iter(data)
+        while True:
+            chunk = list(itertools.islice(iterator, chunksize))
+            if not chunk:
+                return
+            yield chunk
+
+
+def imap(data, f, num_cores=None, chunksize=1, max_pending=None, start_method=None):
+    """
+    imap() is the streaming counterpart of Parallelize(). Elements are sent to the workers in small chunks and the outputs
+    are yielded one by one, in the order of data, as soon as their chunk is finished. At most max_pending chunks are in
+    flight at any time, so the memory used does not depend on the length of data. Also available as Parallelize.imap
+
+    Parameters:
+    ----------------
+    :param data: (iterable, Numpy array or np.memmap) required: the sequence of data to be processed. Generators are consumed lazily
+    :param f: (a function) required: A function that takes in an element of data and returns the desired processed output of that element
+    :param num_cores: (integer) optional: The desired number of cores to allocate. If unspecified, the maximum possible will be used
+    :param chunksize: (integer) optional: The number of elements sent to a worker at once. Default = 1
+    :param max_pending: (integer) optional: The maximum number of chunks submitted but not yet yielded. Default = 2 * num_cores
+    :param start_method: (string) optional: The multiprocessing start method to use ("fork", "spawn" or "forkserver")
+
+    Returns:
+    ----------------
+    Returns a generator yielding the output of f for every element of data, in order
+
+    Example:
+    ----------------
+    >>> with open("processed.npy", "wb") as fh:
+    >>>     for out in Parallelize.imap(np.load("Out2.npy", mmap_mode="r"), get_amygdala_data, 100, chunksize=8):
+    >>>         fh.write(out.tobytes())
+    """
+    if(num_cores == None):
+        num_cores = multiprocessing.cpu_count()
+    num_cores = min(num_cores, multiprocessing.cpu_count())
+    if(max_pending == None):
+        max_pending = 2 * num_cores
+
+    ctx = multiprocessing.get_context(start_method)
+
+    with ctx.Pool(num_cores) as p:
+        yield from _imap(p, data, f, chunksize, max_pending)
+
+
+def _imap(pool, data, f, chunksize, max_pending):
+    """
+    Generator shared by imap() and ParallelExecutor.imap() that streams data through an existing pool
+
+    :param pool: (multiprocessing.pool.Pool) required: The pool running the chunks
+    :param data: (iterable, Numpy array or np.memmap) required: the sequence of data to be processed
+    :param f: (function) required: The function that the elements will be passed to
+    :param chunksize: (integer) required: The number of elements sent to a worker at once
+    :param max_pending: (integer) required: The maximum number of chunks submitted but not yet yielded
+    :return: generator yielding the output of f for every element of data, in order
+    """
+    #Results are collected in submission order, waiting on the oldest chunk keeps the output ordered and the queue bounded
+    pending = collections.deque()
+    for chunk in _iter_chunks(data, chunksize):
+        pending.append(pool.apply_async(__chunk_procedure, (chunk, f)))
+        if len(pending) >= max_pending:
+            yield from pending.popleft().get()
+    while pending:
+        yield from pending.popleft().get()
+
+
+Parallelize.imap = imap
@@ -1,4 +1,55 @@
-from .arrays import  *
-from .conv_functions import *
-from .eigengame import eigengame
-from .Parallelize import Parallelize
+"""
+The submodules are only imported when one of their names is first used (PEP 562), so that importing the package, or
+only Parallelize, does not pay for scipy and the other heavy dependencies.
+"""
+
+import importlib
+import sys
+import types
+
+#Public name -> submodule that defines it
+_LAZY = {
+    "mm_norm": "arrays",
+    "LabelIndex": "arrays",
+    "map_vals_to_index": "arrays",
+    "bin_statistics_by_index": "arrays",
+    "parcellate": "arrays",
+    "linreg": "conv_functions",
+    "EigenGame": "eigengame",
+    "eigengame": "eigengame",
+    "Parallelize": "Parallelize",
+    "ParallelExecutor": "Parallelize",
+    "ParallelStats": "Parallelize",
+    "ElementError": "Parallelize",
+    "worker_state": "Parallelize",
+}
+_SUBMODULES = ("arrays", "conv_functions", "eigengame", "Parallelize")
+
+__all__ = list(_LAZY)
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        value = getattr(importlib.import_module("." + _LAZY[name], __name__), name)
+    elif name in _SUBMODULES:
+        value = importlib.import_module("." + name, __name__)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
+
+
+class _Package(types.ModuleType):
+    def __setattr__(self, name, value):
+        #Importing a submodule sets it as an attribute of the package, but the Parallelize submodule is named like its
+        #main function, which is what NeuralABC_tools.Parallelize has always been
+        if name in _LAZY and isinstance(value, types.ModuleType) and value.__name__ == f"{self.__name__}.{name}":
+            value = getattr(value, name)
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _Package
@@ -3,55 +3,275 @@ Author: Christopher J. Steele
 Date: 2022-03-05
 """
 
+import os
+import warnings
+
 import numpy as np
-from scipy.stats import binned_statistic
 
 
-def mm_norm(array):
+def mm_norm(array, out=None, dtype=None):
     """
     Normalize n-dimensional numpy array to between 0 and 1
 
     :param array: ndarray
+    :param out: ndarray of the same shape to write the result into, e.g. array itself to normalize it in place. No temporary
+                array is allocated
+    :param dtype: floating point type of the result. Default = None, that of out if given, else that of array (float64 for
+                  integer arrays)
     :return: ndarray with range = {0,1}
     """
     mmin = array.min()
     mmax = array.max()
-    return (array - mmin) / (mmax - mmin)
+    if out is None:
+        out = np.empty(array.shape, dtype=_float_dtype(array, dtype))
+    np.subtract(array, mmin, out=out, dtype=out.dtype)
+    return np.divide(out, mmax - mmin, out=out, dtype=out.dtype)
 
 
-def map_vals_to_index(index_array, key_vals):
+def _float_dtype(array, dtype=None):
+    """
+    The floating point type computations on array run in: dtype if given, else the type of array if it is a floating
+    point type (so float32 data stays float32), else float64
+    """
+    if dtype is None:
+        dtype = array.dtype if np.issubdtype(array.dtype, np.floating) else np.float64
+    return np.dtype(dtype)
+
+
+#Largest label for which LabelIndex builds a dense lookup table instead of sorting the labels, and the number of elements
+#LabelIndex.map() gathers at a time into out
+_MAX_LUT_LABEL = 2**20
+_MAP_BLOCK_ELEMENTS = 2**16
+
+
+class LabelIndex():
+    def __init__(self, index_array):
+        """
+        Position of every element of an index (label) array among its sorted unique labels, computed once so that any
+        number of value vectors can be mapped into the array with a single gather each (see map()). Small non-negative
+        integer labels, like those of an atlas, are found with np.bincount and a dense lookup table instead of a sort.
+
+        :param index_array: ndarray of labels (usually of type int)
+        """
+        index_array = np.asarray(index_array)
+        self.shape = index_array.shape
+        if (np.issubdtype(index_array.dtype, np.integer) and index_array.size > 0 and index_array.min() >= 0
+                and index_array.max() <= max(_MAX_LUT_LABEL, index_array.size)):
+            counts = np.bincount(index_array.ravel())
+            self.labels = np.flatnonzero(counts).astype(index_array.dtype)
+            lut = np.zeros(counts.size, dtype=np.int32)
+            lut[self.labels] = np.arange(self.labels.size, dtype=np.int32)
+            self.positions = lut[index_array]
+        else:
+            self.labels, inverse = np.unique(index_array, return_inverse=True)
+            self.positions = inverse.reshape(self.shape).astype(np.int32)
+        self._segments = None
+
+    def segments(self):
+        """
+        The elements of the index array grouped by label, computed on the first call and cached
+
+        :return: (order, starts, sizes): the flat indices of the elements sorted by label, and the start and size of the
+                 segment of every label in that order
+        """
+        if self._segments is None:
+            positions = self.positions.ravel()
+            if self.labels.size <= np.iinfo(np.int16).max:
+                positions = positions.astype(np.int16) # a stable sort of 16 bit integers is a radix sort
+            order = np.argsort(positions, kind="stable")
+            sizes = np.bincount(positions, minlength=self.labels.size)
+            starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+            self._segments = (order, starts, sizes)
+        return self._segments
+
+    def map(self, key_vals, out=None, dtype=None):
+        """
+        Map the values of key_vals into the index array, as map_vals_to_index() does
+
+        :param key_vals: 1-d ndarray with one value per label in increasing label order, or 2-d ndarray (n, labels) to map
+                         n vectors of values at once
+        :param out: C-contiguous ndarray of the shape of the result to write it into, instead of allocating it. It is filled
+                    a block of elements at a time, so no temporary of the size of the result is allocated
+        :param dtype: type of the result. Default = None, that of out if given, else that of key_vals
+        :return: ndarray of shape index_array.shape (or (n,) + index_array.shape for a 2-d key_vals)
+        """
+        if dtype is None and out is not None:
+            dtype = out.dtype
+        key_vals = np.asarray(key_vals, dtype=dtype)
+        if key_vals.shape[-1] != self.labels.size:
+            raise ValueError(f"key_vals has {key_vals.shape[-1]} values per vector, but the index array has {self.labels.size} labels")
+        if out is None:
+            return key_vals[..., self.positions]
+
+        if(out.shape != key_vals.shape[:-1] + self.shape or not out.flags.c_contiguous):
+            raise ValueError(f"out must be a C-contiguous array of shape {key_vals.shape[:-1] + self.shape}")
+        flat_out = out.reshape(key_vals.shape[:-1] + (-1,))
+        positions = self.positions.ravel()
+        for start in range(0, positions.size, _MAP_BLOCK_ELEMENTS):
+            block = slice(start, start + _MAP_BLOCK_ELEMENTS)
+            flat_out[..., block] = key_vals[..., positions[block]]
+        return out
+
+
+def map_vals_to_index(index_array, key_vals, out=None, dtype=None):
     """
     Map a set of values in vector [key_vals] into ndarray [index_array]. The shape of np.unique(index_array) must be
     the same as that of key_vals. The index order of values in key_vals must be the same as the increasing indices of
     index_array. We do not remove the 0 index, the value to fill ALL indices in index_array (i.e., np.unique()) must
-    also be in key_vals.
+    also be in key_vals. To map many vectors into the same index_array, build a LabelIndex once and pass it instead.
 
-    :param index_array: ndarray of type int
-    :param key_vals: 1-d ndarray containing sorted order of values to map to index_array (if 0 in index_array, include 0)
+    :param index_array: ndarray of type int, or a LabelIndex
+    :param key_vals: 1-d ndarray containing sorted order of values to map to index_array (if 0 in index_array, include 0),
+                     or 2-d ndarray (n, labels) to get a stack of n arrays
+    :param out: ndarray of the shape of the result to write it into, instead of allocating it
+    :param dtype: type of the result. Default = None, that of out if given, else that of key_vals (a float32 key_vals
+                  gives a float32 array)
 
     :return: ndarray of shape index_array.shape() with key_vals mapped into ordered indices of index_array
     """
 
-    palette = np.unique(index_array)  # sorted order of values in index_array that we will map to
-    index = np.digitize(index_array, palette, right=True)  # create an index of palette to index_array
-    return key_vals[index]  # fill key_vals into index
+    if not isinstance(index_array, LabelIndex):
+        index_array = LabelIndex(index_array)  # position of every element among the sorted labels
+    return index_array.map(key_vals, out, dtype)  # fill key_vals into index
+
+
+#Statistics computed by bin_statistics_by_index() without scipy, and the number of values it gathers at a time
+_BIN_STATISTICS = ("mean", "std", "median", "count", "sum", "min", "max")
+_BIN_BLOCK_ELEMENTS = 2**24
 
 
 def bin_statistics_by_index(index_array, val_array, statistic='mean', ignore_zero_index=True, remove_nans=True):
     """
-    Wrapper for scipy.stats.binned_statistic
     Calculate a statistic for elements in val_array based on common indices in index_array. Given a vector val_array, the statistic will be computed for all elements with the same index in the ndarray index_array. 
     Background index could be ignored if it is 0, and nans could be ignored (but not removed) to calculate nan<statistics>. Nans elemets in val_array will be cast as 0 in bin_num output.
-    :param index_array: np.ndarray with indices defining regions over which statistic will be calculated
-    :param val_array: np.ndarray with values which will be summarized based on the index_array
-    :param statistic: one of {'mean','std','median','count','sum','min','max',function}
+    The values are gathered in the cached label order of a LabelIndex and reduced per label with np.add.reduceat (and
+    friends), so several statistics are computed together and a whole cohort can be summarized at once. Functions as
+    statistic go through scipy.stats.binned_statistic.
+    :param index_array: np.ndarray with indices defining regions over which statistic will be calculated, or a LabelIndex
+                        of it to reuse its sort order over many calls
+    :param val_array: np.ndarray with values which will be summarized based on the index_array, with as many elements as
+                      index_array (e.g. of its shape, or flattened), or (subjects, ...) with one such array per subject
+    :param statistic: one of {'mean','std','median','count','sum','min','max',function}, or a list of the names to compute together
     :param ignore_zero_index: ignore zero index when mapping data to bins (almost always True)
     :param remove_nans: if True nans are removed from computation (effectively setting the statistic to "nan<stat>")
                         There are edge cases when this will fail, so be careful!
     :return:
-    dict: "stat" containing the calculated statistic, and "bin_num" containing bin indecies as ints.
+    dict: "stat" containing the calculated statistic (a dict of them for a list of statistics, each of shape (labels,)
+    or (subjects, labels)), and "bin_num" containing bin indecies as ints (of the shape of index_array). For a cohort,
+    bin_num is the same for every subject and nans are not cast to 0 in it.
     """
     
+    if callable(statistic):
+        return _binned_statistic_by_index(index_array, val_array, statistic, ignore_zero_index, remove_nans)
+    if not isinstance(index_array, LabelIndex):
+        if not (index_array.dtype == int):
+            print('Your index array is not of type int, please fix!')
+            return 0
+        index_array = LabelIndex(index_array)
+
+    names = _statistic_names(statistic)
+    val_array = np.asarray(val_array)
+    size = int(np.prod(index_array.shape))
+    #The values of a single subject can come in any shape (both arrays are ravelled), a cohort has the subjects first
+    batch = val_array.size != size
+    if batch and (val_array.ndim < 2 or val_array[0].size != size):
+        raise ValueError(f"val_array must have the {size} elements of index_array, or one such array per subject")
+    values = val_array.reshape(-1, size)
+
+    skip = _skipped_labels(index_array, ignore_zero_index)
+    stats = _segment_statistics(index_array, values, names, remove_nans)
+    stats = {name: (stat[:, skip:] if batch else stat[0, skip:]) for name, stat in stats.items()}
+
+    #The bins of a cohort are those of the index array, shared by every subject (their nans are not cast to 0, which
+    #would take a (subjects, voxels) array)
+    bin_num = np.maximum(index_array.positions.reshape(index_array.shape).astype(int) + 1 - skip, 0)
+    if remove_nans and not batch:
+        bin_num[np.isnan(values[0]).reshape(index_array.shape)] = 0
+    return {"stat": stats[statistic] if isinstance(statistic, str) else stats, "bin_num": bin_num}
+
+
+def _statistic_names(statistic):
+    """
+    Check the statistic parameter of bin_statistics_by_index() (a name or a list of names) and return the list of names
+    """
+    names = [statistic] if isinstance(statistic, str) else list(statistic)
+    for name in names:
+        if name not in _BIN_STATISTICS:
+            raise ValueError(f"statistic must be one of {_BIN_STATISTICS} or a function, got {name!r}")
+    return names
+
+
+def _skipped_labels(index, ignore_zero_index):
+    """
+    Label 0 is the background: with ignore_zero_index, its bin is dropped from the statistics (and its elements get bin
+    number 0). Return the number of labels dropped from the start of index.labels, 0 or 1
+    """
+    return int(ignore_zero_index and index.labels.size > 0 and index.labels[0] == 0)
+
+
+def _segment_statistics(index, values, names, remove_nans):
+    """
+    Compute the statistics in names for every label of a LabelIndex, for every row of values
+
+    :param index: LabelIndex
+    :param values: 2-d ndarray (subjects, elements of the index array)
+    :param names: list of statistics, see _BIN_STATISTICS
+    :param remove_nans: ignore nans
+    :return: dict of 2-d ndarrays (subjects, labels)
+    """
+    order, starts, sizes = index.segments()
+    stats = {name: np.empty((values.shape[0], sizes.size)) for name in names}
+
+    #Subjects are gathered in blocks, so the sorted copy of the values stays bounded
+    block = max(1, _BIN_BLOCK_ELEMENTS // max(1, order.size))
+    for first in range(0, values.shape[0], block):
+        rows = slice(first, first + block)
+        gathered = np.asarray(values[rows], dtype=np.float64)[:, order]
+        if remove_nans:
+            valid = ~np.isnan(gathered)
+            counts = np.add.reduceat(valid, starts, axis=1).astype(np.float64)
+            filled = np.where(valid, gathered, 0)
+        else:
+            counts = np.broadcast_to(sizes.astype(np.float64), (gathered.shape[0], sizes.size))
+            filled = gathered
+        sums = np.add.reduceat(filled, starts, axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = sums / counts
+            if "std" in stats:
+                deviations = filled - np.repeat(means, sizes, axis=1)
+                if remove_nans:
+                    deviations[~valid] = 0
+                stats["std"][rows] = np.sqrt(np.add.reduceat(deviations**2, starts, axis=1) / counts)
+
+        if "mean" in stats:
+            stats["mean"][rows] = means
+        if "sum" in stats:
+            stats["sum"][rows] = sums
+        if "count" in stats:
+            stats["count"][rows] = counts
+        if "min" in stats:
+            stats["min"][rows] = (np.fmin if remove_nans else np.minimum).reduceat(gathered, starts, axis=1)
+        if "max" in stats:
+            stats["max"][rows] = (np.fmax if remove_nans else np.maximum).reduceat(gathered, starts, axis=1)
+        if "median" in stats:
+            median = np.nanmedian if remove_nans else np.median
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning) #labels whose values are all nan
+                for label, (start, stop) in enumerate(zip(starts, starts + sizes)):
+                    stats["median"][rows, label] = median(gathered[:, start:stop], axis=1)
+    return stats
+
+
+def _binned_statistic_by_index(index_array, val_array, statistic='mean', ignore_zero_index=True, remove_nans=True):
+    """
+    Wrapper for scipy.stats.binned_statistic, used by bin_statistics_by_index() for statistics given as functions.
+    See bin_statistics_by_index() for the parameters
+    """
+    from scipy.stats import binned_statistic
+
+    if isinstance(index_array, LabelIndex):
+        index_array = index_array.labels[index_array.positions]
+
     if not (index_array.dtype == int):
         print('Your index array is not of type int, please fix!')
         return 0
@@ -82,6 +302,84 @@ def bin_statistics_by_index(index_array, val_array, statistic='mean', ignore_zer
 
 
 
+def parcellate(images, atlas, statistic='mean', ignore_zero_index=True, remove_nans=True, num_cores=None, backend="thread", out=None):
+    """
+    Summarize every subject of a cohort by the regions of an atlas. The atlas is parsed once into a LabelIndex (with its
+    sort order), then the subjects are streamed through bin_statistics_by_index() on num_cores workers, each volume
+    being read (memory-mapped when possible) only when its subject is processed, and the statistics are written into
+    a subjects X regions table.
+
+    :param images: list of paths (.npy, or NIfTI read with nibabel), one volume per subject, or a 4-D array (or the path of a
+                   4-D file) with the subjects along the first or the last axis
+    :param atlas: np.ndarray, path of the atlas volume, or LabelIndex of it
+    :param statistic: one of {'mean','std','median','count','sum','min','max'}, or a list of them
+    :param ignore_zero_index: ignore zero index of the atlas (almost always True)
+    :param remove_nans: if True nans are removed from computation (effectively setting the statistic to "nan<stat>")
+    :param num_cores: number of workers, see Parallelize(). None to use all the cores
+    :param backend: backend of Parallelize(). The default "thread" shares the LabelIndex between the workers, reading the
+                    volumes and the reductions run outside of the GIL
+    :param out: preallocated (subjects, statistics * regions) array or path of a .npy memmap for the table, see Parallelize()
+    :return:
+    dict: "stat" containing the subjects X regions table of the statistic (a dict of them for a list of statistics), and
+    "labels" containing the label of every region (column)
+    """
+    from functools import partial
+    from .Parallelize import Parallelize
+
+    if not isinstance(atlas, LabelIndex):
+        atlas = _load_volume(atlas)
+        if not np.issubdtype(atlas.dtype, np.integer) and np.array_equal(atlas, np.round(atlas)):
+            atlas = atlas.astype(int) # atlases are often stored as floats
+        atlas = LabelIndex(atlas)
+    atlas.segments() # sort the labels once, before the workers share the index
+    names = _statistic_names(statistic)
+    skip = _skipped_labels(atlas, ignore_zero_index)
+
+    if isinstance(images, (str, os.PathLike)):
+        images = _load_volume(images)
+    if isinstance(images, np.ndarray):
+        if images.shape[1:] == atlas.shape:
+            subjects = images
+        elif images.shape[:-1] == atlas.shape:
+            subjects = np.moveaxis(images, -1, 0)
+        else:
+            raise ValueError(f"images of shape {images.shape} do not stack volumes of the atlas shape {atlas.shape}")
+    else:
+        subjects = list(images)
+
+    summarize = partial(_parcellate_subject, atlas=atlas, names=names, skip=skip, remove_nans=remove_nans)
+    table = Parallelize(subjects, summarize, num_cores, backend=backend, out=out)
+
+    num_regions = atlas.labels.size - skip
+    stats = {name: table[:, k * num_regions:(k + 1) * num_regions] for k, name in enumerate(names)}
+    return {"stat": stats[statistic] if isinstance(statistic, str) else stats, "labels": atlas.labels[skip:]}
+
+
+def _parcellate_subject(volume, atlas, names, skip, remove_nans):
+    """
+    _parcellate_subject is a helper function used by parcellate() and should never be called outside of it. It reads
+    the volume of a subject and returns its statistics, concatenated in the order of names
+    """
+    values = np.asarray(_load_volume(volume)).reshape(1, -1)
+    if values.shape[1] != atlas.positions.size:
+        raise ValueError(f"a volume of {values.shape[1]} voxels does not match the atlas shape {atlas.shape}")
+    stats = _segment_statistics(atlas, values, names, remove_nans)
+    return np.concatenate([stats[name][0, skip:] for name in names])
+
+
+def _load_volume(source):
+    """
+    Return the array of a volume given as an array or a path: .npy files are memory-mapped, the other files are read with
+    nibabel (memory-mapped when they are not compressed)
+    """
+    if not isinstance(source, (str, os.PathLike)):
+        return np.asanyarray(source)
+    if os.fspath(source).endswith(".npy"):
+        return np.load(source, mmap_mode="r")
+    import nibabel as nb
+    return np.asanyarray(nb.load(source, mmap=True).dataobj)
+
+
 # slower implementations for testing
 def _loop_map_vals_to_index(index_array, key_vals):
     """
@@ -94,7 +392,7 @@ def _loop_map_vals_to_index(index_array, key_vals):
     """
 
     index_array_vals = np.unique(index_array)  # returns ordered vector, equivalent to ordering of key_vals
-    d_out = np.zeros(index_array.shape)
+    d_out = np.zeros(index_array.shape, dtype=np.asarray(key_vals).dtype)
     for idx, val in enumerate(index_array_vals):
         d_out[index_array == val] = key_vals[idx]
     return d_out
@@ -113,8 +411,8 @@ def _loop_mean_statistics_by_index(index_array, val_array, ignore_zero_index=Tru
     if ignore_zero_index and unique[0] == 0:
         unique = unique[1:]
     stat = np.zeros(unique.shape)
-    for idx in unique:
+    for i, idx in enumerate(unique):
         m = (index_array == idx)
-        stat[idx] = np.mean(val_array[m])
+        stat[i] = np.mean(val_array[m])
     return {"stat": stat}
 
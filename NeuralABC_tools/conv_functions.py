@@ -1,12 +1,18 @@
 #Convincence functions for NeuralABC
 
 
-def linreg(iv, dv, cov=None, verbose=1,save_r= True, save_r2=True, save_betas=True, save_pvals=True, save_tstats=True, save_res=True):
+def linreg(iv, dv, cov=None, verbose=1,save_r= True, save_r2=True, save_betas=True, save_pvals=True, save_tstats=True, save_res=True, residualize=True,
+           n_jobs=1, chunksize=None, output="dict", out_dir=None, n_perm=0, seed=None):
     """
     Run multiple regression with covariates.
-    Not yet parallized.
     zklsmr
 
+    Every IV column is regressed against all the DV columns in a single least squares solve (see _ols_fit), with the same
+    results as running pingouin.linear_regression() on every IV/DV pair. By default, the intercept and covariates are
+    even projected out of all the IV and DV columns once, and every IV/DV pair is then a simple regression on the
+    residualized columns (see _linreg_design). The DV columns are processed in chunks, on n_jobs threads, and the
+    results are written into dense IV X DV arrays, so the memory used is bounded by the size of a chunk and of the results.
+
     :param iv: (arr, dict, df), required: Independent variable with the shape participant X features.
     :param dv: (arr, dict, df), required: Dependent variable with the shape participant X features.
     :param cov: (arr, dict, df), optional: Covariates with the shape participant X features. default=None
@@ -17,9 +23,25 @@ def linreg(iv, dv, cov=None, verbose=1,save_r= True, save_r2=True, save_betas=Tr
     :param save_pvals: (Bool), optional: Save p-values of the model (type float). default=True.
     :param save_tstats: (Bool), optional: Save t-values of the model (beta / SE) (type float). default=True.
     :param save_res: (Bool), optional: Save residuals of the model (participant X residual) (type float). default=True.
+    :param residualize: (Bool), optional: Project the covariates out of the IV and DV once (Frisch-Waugh-Lovell) instead of
+                        refitting them with every IV. Same results, but adding covariates is almost free. default=True.
+    :param n_jobs: (int), optional: Number of threads that process the chunks of DV columns, None for all the cores. default=1.
+    :param chunksize: (int), optional: Number of DV columns per chunk. default=None, about 4 million values of the DV per chunk.
+    :param output: (str), optional: "dict" for the nested dictionaries below, "arrays" for the dense arrays (IV X DV, and
+                   IV X participant X DV for the residuals) along with the "iv_columns" and "dv_columns" labels. default="dict".
+    :param out_dir: (path), optional: With output="arrays", create the arrays as .npy memmaps in this directory (e.g.
+                    out_dir/t_values.npy) for results that do not fit in memory. A DV given as np.memmap is also read
+                    one chunk at a time. default=None.
+    :param n_perm: (int), optional: Number of permutations for permutation p-values. The residualized IV is permuted
+                   (Smith procedure) with the same permutations for every DV, and all the permutations of a chunk are
+                   a few batched matrix products. Adds 'perm_p_values' (uncorrected) and 'fwer_p_values' (corrected
+                   with the maximum |t| over the DV columns of each IV) to the results. Needs residualize=True. default=0.
+    :param seed: (int), optional: Seed of the permutations, for reproducible p-values. default=None.
 
     :returns dict: Everything you said you want in one dictionary. It is up to you to parse it after based on dict keys.
         dict.keys() = ['corr_coefs', 'r_squared', 'reg_coefs', 'p_values', 't_values', 'residuals']
+        With output="arrays", the values are arrays (None for the ones not saved) and the keys 'iv_columns' and
+        'dv_columns' are added.
 
     Example:
     
@@ -40,12 +62,7 @@ def linreg(iv, dv, cov=None, verbose=1,save_r= True, save_r2=True, save_betas=Tr
         __________________________________
         Starting Regression
         __________________________________
-        working on ---> var1
-        Finished ---> var1
-        __________________________________
-        working on ---> var2
-        Finished ---> var2
-        __________________________________
+        working on ---> DV columns 0 to 0
         Done regression, saving output to dict
         _______________________________________
         Your regression analysis took 0.0 minutes
@@ -69,6 +86,356 @@ def linreg(iv, dv, cov=None, verbose=1,save_r= True, save_r2=True, save_betas=Tr
         0  0.717737 -0.927979
     """    
 
+    import pandas as pd
+    import numpy as np
+    import time
+    from functools import partial
+    from .Parallelize import Parallelize
+
+    start = time.time()
+
+    if output not in ("dict", "arrays"):
+        raise ValueError(f"output must be 'dict' or 'arrays', got {output!r}")
+    if(out_dir != None and output != "arrays"):
+        raise ValueError("out_dir can only be used with output='arrays'")
+    if(n_perm > 0 and not residualize):
+        raise ValueError("n_perm needs residualize=True")
+
+    #convert to pandas df
+    if verbose >=1:
+        print("__________________________________")
+        print("Converting your data to pandas dataframes")
+
+    IV = pd.DataFrame(iv)
+    x = IV.to_numpy(dtype=float)
+
+    #Arrays (and memmaps) of DVs are read one chunk of columns at a time instead of being converted as a whole
+    if isinstance(dv, np.ndarray):
+        Y = dv.reshape(dv.shape[0], -1)
+        dv_columns = pd.RangeIndex(Y.shape[1])
+    else:
+        DV = pd.DataFrame(dv)
+        Y = DV.to_numpy(dtype=float)
+        dv_columns = DV.columns
+    
+    if cov is not None:
+        Cov = pd.DataFrame(cov)
+        cov_values = Cov.to_numpy(dtype=float)
+    else:
+        cov_values = np.empty((x.shape[0], 0))
+    if not (np.isfinite(x).all() and np.isfinite(cov_values).all()):
+        raise ValueError("The IV, DV and covariates must not contain NaN or Inf")
+
+    if verbose >=1:
+        print("__________________________________")
+        print("Starting Regression")
+        print("__________________________________")
+
+    n_subjects, n_iv, n_dv = x.shape[0], x.shape[1], Y.shape[1]
+    saved = {"corr_coefs": save_r is not False and cov is None, "r_squared": save_r2 is not False,
+             "reg_coefs": save_betas is not False, "p_values": save_pvals is not False, "t_values": save_tstats is not False}
+    results = {key: _linreg_array(out_dir, key, (n_iv, n_dv)) for key in saved if saved[key]}
+    if save_res is not False:
+        results["residuals"] = _linreg_array(out_dir, "residuals", (n_iv, n_subjects, n_dv))
+
+    design = _linreg_design(x, cov_values, residualize)
+    if n_perm > 0:
+        #The permutations are drawn once, so they are the same for all the chunks and do not depend on n_jobs
+        rng = np.random.default_rng(seed)
+        design["permutations"] = np.array([rng.permutation(n_subjects) for perm in range(n_perm)])
+        results["perm_p_values"] = _linreg_array(out_dir, "perm_p_values", (n_iv, n_dv))
+        results["fwer_p_values"] = _linreg_array(out_dir, "fwer_p_values", (n_iv, n_dv))
+        if "t_values" not in results: #the observed t-values are compared to the maximum over all the chunks at the end
+            results["t_values"] = np.empty((n_iv, n_dv))
+    if(chunksize == None):
+        chunksize = max(1, _LINREG_CHUNK_ELEMENTS // n_subjects)
+    chunks = [range(first, min(first + chunksize, n_dv)) for first in range(0, n_dv, chunksize)]
+
+    #The chunks of DV columns write their statistics into the result arrays themselves
+    run_chunk = partial(_linreg_chunk, Y=Y, design=design, results=results, verbose=verbose)
+    if(n_jobs == 1 or len(chunks) == 1):
+        null_maxima = [run_chunk(columns) for columns in chunks]
+    else:
+        null_maxima = Parallelize(chunks, run_chunk, n_jobs, backend="thread", chunksize=1, ragged="list")
+
+    if n_perm > 0:
+        _fwer_p_values(results, np.fmax.reduce(null_maxima), n_perm, design["degenerate"])
+        if not saved["t_values"]:
+            del results["t_values"]
+
+    for array in results.values():
+        if isinstance(array, np.memmap):
+            array.flush()
+
+    if verbose >=1:
+            print("Done regression, saving output to dict")
+            print("_______________________________________")
+
+        
+    if verbose >=2:
+        end = time.time()
+        ittook = (end - start)/60
+        print(f"Your regression analysis took {np.round(ittook, 2)} minutes")
+        print("=========================================================")
+
+    keys = ["corr_coefs", "r_squared", "reg_coefs", "p_values", "t_values", "residuals"]
+    if n_perm > 0:
+        keys += ["perm_p_values", "fwer_p_values"]
+        saved.update(perm_p_values=True, fwer_p_values=True)
+
+    if output == "arrays":
+        out_put = {key: results.get(key) for key in keys}
+        out_put["iv_columns"] = IV.columns
+        out_put["dv_columns"] = dv_columns
+        return out_put
+
+    #Nested dictionaries: IV column -> list over the DV columns (dict of DV column -> residual array for the residuals)
+    out_put = {key: {} for key in keys}
+    for i, col1 in enumerate(IV.columns):
+        for key in saved:
+            if saved[key]:
+                out_put[key][col1] = list(results[key][i])
+        if save_res is not False:
+            out_put["residuals"][col1] = {col2: results["residuals"][i, :, j] for j, col2 in enumerate(dv_columns)}
+    return out_put
+
+
+#Number of values of the DV (participants X columns) handled at a time by a chunk of linreg()
+_LINREG_CHUNK_ELEMENTS = 2**22
+
+
+def _linreg_array(out_dir, name, shape):
+    """
+    Allocate an output array of linreg(), as a .npy memmap named after it in out_dir if out_dir is given
+    """
+    import os
+    import numpy as np
+
+    if(out_dir == None):
+        return np.empty(shape)
+    os.makedirs(out_dir, exist_ok=True)
+    return np.lib.format.open_memmap(os.path.join(out_dir, name + ".npy"), mode="w+", dtype=np.float64, shape=shape)
+
+
+def _linreg_design(x, cov, residualize):
+    """
+    _linreg_design is a helper function used by linreg() and should never be called outside of it. It prepares what
+    all the chunks of DV columns share. With residualize, by the Frisch-Waugh-Lovell theorem, the coefficient of an IV
+    in the model y ~ 1 + iv + cov is the coefficient of the simple regression of the residualized y on the residualized
+    iv, the residuals being those of the intercept and covariates. These are projected out with an orthonormal basis of
+    [1, cov], computed once here along with the residualized IV columns.
+
+    :param x: (2D array), required: the independent variables, participant X features
+    :param cov: (2D array), required: the covariates, participant X covariates (possibly no columns)
+    :param residualize: (Bool), required: the residualize parameter of linreg()
+    :return: dict
+    """
+    import numpy as np
+
+    design = {"x": x, "cov": cov, "residualize": residualize, "x_std": np.std(x, axis=0, ddof=1), "has_cov": cov.shape[1] > 0}
+    if not residualize:
+        design["degenerate"] = np.ones(x.shape[1], dtype=bool)
+        return design
+
+    n = x.shape[0]
+    full = np.column_stack((np.ones(n), cov))
+    u, s, vt = np.linalg.svd(full, full_matrices=False)
+    basis = u[:, s > max(n, full.shape[1]) * np.finfo(float).eps * s[0]]
+    x_res = x - basis @ (basis.T @ x)
+    ss_x = np.einsum("ij,ij->j", x_res, x_res)
+
+    #An IV in the span of the covariates makes the full design rank deficient, it is fitted with _ols_fit instead
+    tol = max(n, full.shape[1] + 1) * np.finfo(float).eps
+    degenerate = ss_x <= tol**2 * np.einsum("ij,ij->j", x, x)
+    design.update(basis=basis, x_res=x_res, ss_x=np.where(degenerate, 1, ss_x), degenerate=degenerate)
+    return design
+
+
+def _linreg_chunk(columns, Y, design, results, verbose=1):
+    """
+    _linreg_chunk is a helper function used by linreg() and should never be called outside of it. It regresses every IV
+    on the DV columns of one chunk and writes the statistics into the result arrays, so only the chunk is ever in memory.
+
+    :param columns: (range), required: the DV columns of the chunk
+    :param Y: (2D array or np.memmap), required: the dependent variables, participant X features
+    :param design: (dict), required: see _linreg_design()
+    :param results: (dict), required: the result arrays of linreg(), IV X DV (IV X participant X DV for the residuals)
+    :param verbose: (int), optional: the verbose parameter of linreg(). default=1
+    :return: with permutations, the maximum |t| of every IV over the DV columns of the chunk for every permutation
+             (IV X permutations), otherwise None
+    """
+    import numpy as np
+    from scipy import stats
+
+    if verbose >= 2:
+        print(f"working on ---> DV columns {columns.start} to {columns.stop - 1}")
+
+    y = np.asarray(Y[:, columns.start:columns.stop], dtype=float)
+    if not np.isfinite(y).all():
+        raise ValueError("The IV, DV and covariates must not contain NaN or Inf")
+    centered = y - y.mean(axis=0)
+    ss_tot = np.einsum("ij,ij->j", centered, centered)
+    chunk = {}
+
+    if design["residualize"]:
+        basis, x_res, ss_x = design["basis"], design["x_res"], design["ss_x"]
+        y_res = y - basis @ (basis.T @ y)
+        ss_y = np.einsum("ij,ij->j", y_res, y_res)
+
+        chunk["coef"] = (x_res.T @ y_res) / ss_x[:, np.newaxis]
+        ss_res = np.maximum(ss_y - chunk["coef"]**2 * ss_x[:, np.newaxis], 0)
+        df_resid = y.shape[0] - basis.shape[1] - 1
+        with np.errstate(divide="ignore", invalid="ignore"):
+            chunk["r2"] = 1 - ss_res / ss_tot
+            chunk["T"] = chunk["coef"] / np.sqrt(ss_res / df_resid / ss_x[:, np.newaxis])
+        chunk["pval"] = 2 * stats.t.sf(np.fabs(chunk["T"]), df_resid)
+    else:
+        chunk = {key: np.empty((design["x"].shape[1], y.shape[1])) for key in ("coef", "r2", "T", "pval")}
+
+    #Without residualization, or for an IV that the covariates explain entirely, fit the whole model
+    fits = {}
+    for i in np.flatnonzero(design["degenerate"]):
+        fits[i] = _ols_fit(np.column_stack((design["x"][:, i], design["cov"])), y)
+        for key in ("coef", "T", "pval"):
+            chunk[key][i] = fits[i][key][1]
+        chunk["r2"][i] = fits[i]["r2"]
+
+    names = {"reg_coefs": "coef", "r_squared": "r2", "t_values": "T", "p_values": "pval"}
+    for key, name in names.items():
+        if key in results:
+            results[key][:, columns.start:columns.stop] = chunk[name]
+    if "corr_coefs" in results:
+        results["corr_coefs"][:, columns.start:columns.stop] = chunk["coef"] * np.outer(design["x_std"], 1 / np.std(y, axis=0, ddof=1))
+    if "residuals" in results:
+        for i in range(design["x"].shape[1]):
+            if i in fits:
+                results["residuals"][i, :, columns.start:columns.stop] = fits[i]["residuals"]
+            else:
+                results["residuals"][i, :, columns.start:columns.stop] = y_res - np.outer(x_res[:, i], chunk["coef"][i])
+
+    if "permutations" in design:
+        counts, null_max = _permutation_tests(design, y_res, ss_y, np.fabs(chunk["T"]))
+        results["perm_p_values"][:, columns.start:columns.stop] = counts
+        return null_max
+
+
+def _permutation_tests(design, y_res, ss_y, t_abs):
+    """
+    _permutation_tests is a helper function used by linreg() and should never be called outside of it. It computes the
+    t-values of every permutation of the residualized IV columns against the residualized DV columns of a chunk. As in
+    the Smith procedure, every permuted IV is fitted in the full model [1, permuted IV, cov], so by Frisch-Waugh-Lovell
+    it is residualized against the covariates again and has its own sum of squares. The permuted IVs of a batch of
+    permutations are stacked side by side, so each batch is one matrix product with the DV.
+
+    :param design: (dict), required: see _linreg_design(), with the "permutations" (permutations X participant)
+    :param y_res: (2D array), required: the residualized DV columns of the chunk, participant X columns
+    :param ss_y: (1D array), required: the sums of squares of y_res
+    :param t_abs: (2D array), required: the observed |t| of the chunk, IV X columns
+    :return: the number of permutations whose |t| reaches the observed |t| (IV X columns), and the maximum |t| of every IV
+             over the columns for every permutation (IV X permutations)
+    """
+    import numpy as np
+
+    x_res, basis, permutations = design["x_res"], design["basis"], design["permutations"]
+    n, n_iv = x_res.shape
+    df_resid = n - design["basis"].shape[1] - 1
+    counts = np.zeros(t_abs.shape)
+    null_max = np.empty((n_iv, len(permutations)))
+
+    batch = max(1, _LINREG_CHUNK_ELEMENTS // (n_iv * max(n, y_res.shape[1])))
+    for first in range(0, len(permutations), batch):
+        perms = permutations[first:first + batch]
+        #participant X (permutation, IV) -> (permutation, IV) X columns
+        stacked = x_res[perms].transpose(1, 0, 2).reshape(n, -1)
+        stacked = stacked - basis @ (basis.T @ stacked)
+        #(permutation, IV) X 1, the sums of squares of the permuted IVs once residualized again
+        ss_perm = np.einsum("ij,ij->j", stacked, stacked).reshape(len(perms), n_iv, 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            coef = (stacked.T @ y_res).reshape(len(perms), n_iv, -1) / ss_perm
+            ss_res = np.maximum(ss_y - coef**2 * ss_perm, 0)
+            t_perm = np.fabs(coef / np.sqrt(ss_res / df_resid / ss_perm))
+        counts += np.sum(t_perm >= t_abs, axis=0)
+        #Constant DV columns have no t-value, they are left out of the maximum
+        null_max[:, first:first + batch] = np.fmax.reduce(t_perm, axis=2).T
+    return counts, null_max
+
+
+def _fwer_p_values(results, null_max, n_perm, degenerate):
+    """
+    Turn the permutation counts of linreg() into p-values, and compute the p-values corrected for the family-wise error
+    rate from the distribution of the maximum |t| of every IV over all the DV columns (IV X permutations). The IVs that
+    are degenerate (see _linreg_design) and the IV/DV pairs without a t-value get NaN p-values
+    """
+    import numpy as np
+
+    for i in range(null_max.shape[0]):
+        if degenerate[i]: #an IV that the covariates explain entirely has nothing to permute
+            results["perm_p_values"][i] = np.nan
+            results["fwer_p_values"][i] = np.nan
+            continue
+        results["perm_p_values"][i] = (1 + results["perm_p_values"][i]) / (n_perm + 1)
+        exceeding = n_perm - np.searchsorted(np.sort(null_max[i]), np.fabs(results["t_values"][i]), side="left")
+        results["fwer_p_values"][i] = (1 + exceeding) / (n_perm + 1)
+        missing = np.isnan(results["t_values"][i])
+        results["perm_p_values"][i, missing] = np.nan
+        results["fwer_p_values"][i, missing] = np.nan
+
+
+def _ols_fit(x, Y):
+    """
+    _ols_fit is a helper function used by linreg() and should never be called outside of it. It fits the model
+    Y[:, j] ~ 1 + x for every column j of Y with one QR decomposition of the shared design matrix, instead of one
+    pingouin.linear_regression() call per column. The statistics are computed like pingouin does: minimum norm least
+    squares through the SVD of the triangular factor, the rank deciding the degrees of freedom, and all-zero predictors
+    getting a coefficient and standard error of zero.
+
+    :param x: (2D array), required: the predictors, participant X predictors (the IV first, then the covariates), without intercept
+    :param Y: (2D array), required: the dependent variables, participant X features
+    :return: dict of arrays: "coef", "se", "T" and "pval" (1 + predictors X features, the intercept first), "r2"
+             (features) and "residuals" (participant X features)
+    """
+    import numpy as np
+    from scipy import stats
+
+    if not (np.isfinite(x).all() and np.isfinite(Y).all()):
+        raise ValueError("The IV, DV and covariates must not contain NaN or Inf")
+
+    n = x.shape[0]
+    X = np.column_stack((np.ones(n), x))
+    p = X.shape[1]
+
+    nonzero = X.any(axis=0)
+    Q, R = np.linalg.qr(X[:, nonzero])
+    u, s, vt = np.linalg.svd(R, full_matrices=False)
+    rank = int(np.sum(s > max(n, p) * np.finfo(float).eps * s[0]))
+    scaled_vt = vt[:rank] / s[:rank, np.newaxis]
+
+    unscaled_var = np.zeros(p)
+    unscaled_var[nonzero] = np.sum(scaled_vt**2, axis=0)
+    coef = np.zeros((p, Y.shape[1]))
+    coef[nonzero] = scaled_vt.T @ (u[:, :rank].T @ (Q.T @ Y))
+
+    residuals = Y - X @ coef
+    ss_res = np.einsum("ij,ij->j", residuals, residuals)
+    centered = Y - Y.mean(axis=0)
+    ss_tot = np.einsum("ij,ij->j", centered, centered)
+
+    df_resid = n - rank
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r2 = 1 - ss_res / ss_tot
+        se = np.sqrt(ss_res / df_resid * unscaled_var[:, np.newaxis])
+        T = coef / se
+    pval = 2 * stats.t.sf(np.fabs(T), df_resid)
+    return {"coef": coef, "se": se, "T": T, "pval": pval, "r2": r2, "residuals": residuals}
+
+
+# slower implementations for testing
+def _loop_linreg(iv, dv, cov=None, verbose=1,save_r= True, save_r2=True, save_betas=True, save_pvals=True, save_tstats=True, save_res=True):
+    """
+    Original linreg() that calls pingouin.linear_regression() for every IV/DV pair. For comparison with the faster
+    implementation, see linreg() for the parameters.
+    """    
+
     import pandas as pd
     import numpy as np
     import pingouin as pg
@@ -1,5 +1,9 @@
+import warnings
+
 import numpy as np
 
+from .arrays import _float_dtype
+
 def calc_penalties(data, vectors, index):
     """
     calc_penalties is a helper function used by eigengame() and should never be called outside
@@ -29,8 +33,384 @@ def calc_penalties(data, vectors, index):
 
     return penalties 
 
+
+def _sequential_eigengame(data, n_components, epochs, learning_rate, tol=None, adaptive=False, init=None):
+    """
+    _sequential_eigengame is a helper function used by eigengame() and EigenGame and should never be called outside
+    of them. It learns the eigenvectors one after the other, like the original algorithm. A finished vector does not
+    change anymore, so its projection data @ v is computed once and cached instead of being recomputed by calc_penalties
+    at every epoch of every later vector, which makes the penalties O(n * t) instead of O(n * d * t).
+
+    Parameters:
+    ----------------
+    :param data: (2D array), required: the data array for which we want to run PCA on, in the form (samples, features)
+    :param n_components: (int), required: the number of principal components to extract
+    :param epochs: (int), required: the (maximum) number of iterations to calculate each eigenvector
+    :param learning_rate: (float), required: Learning rate of the algorithm
+    :param tol: (float), optional: stop a vector once it moves by less than tol in an iteration. Default = None, always run epochs iterations
+    :param adaptive: (bool), optional: adapt the learning rate of each vector to its utility. Default = False
+    :param init: (2D array), optional: the starting eigenvectors (n_components, features). Default = None, vectors of ones
+
+    Returns:
+    ----------------
+    :returns vectors: the eigenvectors, stacked horizontally (features, n_components), of the type of data
+    :returns info: the convergence diagnostics, see _convergence_info()
+    """
+    dim = data.shape[1]
+    vectors = np.ones((dim, n_components), dtype=data.dtype) if init is None else _normalized_init(init, dim, n_components, data.dtype)
+    projections = np.zeros((data.shape[0], n_components), dtype=data.dtype)
+    projection_norms = np.zeros(n_components, dtype=data.dtype)
+    info = _convergence_info(n_components)
+    for t in range(n_components):
+        step = learning_rate
+        rewards = np.dot(data, vectors[:, t])
+        utility = _utility(rewards / np.linalg.norm(vectors[:, t]), projections[:, :t], projection_norms[:t])
+        for epoch in range(epochs):
+            penalties = np.dot(projections[:, :t], np.dot(rewards, projections[:, :t]) / projection_norms[:t])
+
+            delta_v = 2*np.dot(data.T, rewards - penalties)
+            vector = vectors[:, t] + step * delta_v
+            vector = vector / np.linalg.norm(vector)
+            new_rewards = np.dot(data, vector)
+            info["n_iter"][t] += 1
+
+            if adaptive:
+                new_utility = _utility(new_rewards, projections[:, :t], projection_norms[:t])
+                if new_utility < utility - _UTILITY_SLACK * abs(utility): #the step overshot, try again with a smaller one
+                    step = step / 2
+                    continue
+                step = min(step * 1.5, learning_rate * _MAX_STEP_GROWTH)
+                utility = new_utility
+
+            info["change"][t] = np.linalg.norm(vector - vectors[:, t])
+            vectors[:, t] = vector
+            rewards = new_rewards
+            if(tol != None and info["change"][t] < tol):
+                info["converged"][t] = True
+                break
+
+        projections[:, t] = rewards
+        projection_norms[t] = np.dot(rewards, rewards)
+    return vectors, info
+
+
+def _parallel_eigengame(data, n_components, epochs, learning_rate, tol=None, adaptive=False, init=None):
+    """
+    _parallel_eigengame is a helper function used by eigengame() and EigenGame and should never be called outside
+    of them. All the players update their vector at the same time, in the style of mu-EigenGame, so that every epoch
+    is two BLAS matrix products with all the vectors at once, data @ vectors and data.T @ (rewards - penalties),
+    plus O(n * k^2) work on the projections. It uses the same utilities as the sequential algorithm, so it converges
+    to the same eigenvectors, but the later vectors need their parents to settle first and may need more epochs.
+
+    Parameters:
+    ----------------
+    :param data: (2D array), required: the data array for which we want to run PCA on, in the form (samples, features)
+    :param n_components: (int), required: the number of principal components to extract
+    :param epochs: (int), required: the (maximum) number of simultaneous updates of all the vectors
+    :param learning_rate: (float), required: Learning rate of the algorithm
+    :param tol: (float), optional: stop once no vector moves by more than tol in an epoch. Default = None, always run epochs epochs
+    :param adaptive: (bool), optional: adapt the learning rate of each vector to its utility. Default = False
+    :param init: (2D array), optional: the starting eigenvectors (n_components, features). Default = None, see _initial_vectors()
+
+    Returns:
+    ----------------
+    :returns vectors: the eigenvectors, stacked horizontally (features, n_components), of the type of data
+    :returns info: the convergence diagnostics, see _convergence_info()
+
+    References:
+    ----------------
+    "EigenGame Unloaded: When playing games is better than optimizing"; Gemp et al., 2021
+    """
+    dim = data.shape[1]
+    vectors = _initial_vectors(dim, n_components, data.dtype) if init is None else _normalized_init(init, dim, n_components, data.dtype)
+    steps = np.full(n_components, learning_rate, dtype=data.dtype)
+    info = _convergence_info(n_components)
+    rewards = np.dot(data, vectors)
+    gram = np.dot(rewards.T, rewards)
+    for epoch in range(epochs):
+        #coefficients[i, t] = <X v_t, X v_i> / <X v_i, X v_i> for every parent i < t of player t
+        coefficients = np.triu(gram / np.diag(gram)[:, None], k=1)
+        penalties = np.dot(rewards, coefficients)
+
+        delta_v = 2*np.dot(data.T, rewards - penalties)
+        new_vectors = vectors + steps * delta_v
+        new_vectors = new_vectors / np.linalg.norm(new_vectors, axis=0)
+        new_rewards = np.dot(data, new_vectors)
+        new_gram = np.dot(new_rewards.T, new_rewards)
+        info["n_iter"] += 1
+
+        if adaptive:
+            #Players whose step overshot keep their vector and try again with a smaller step
+            utilities = _utilities(rewards)
+            overshot = _utilities(new_rewards) < utilities - _UTILITY_SLACK * np.abs(utilities)
+            steps = np.where(overshot, steps / 2, np.minimum(steps * 1.5, learning_rate * _MAX_STEP_GROWTH))
+            if overshot.any():
+                new_vectors[:, overshot] = vectors[:, overshot]
+                new_rewards[:, overshot] = rewards[:, overshot]
+                new_gram = np.dot(new_rewards.T, new_rewards)
+
+        info["change"] = np.linalg.norm(new_vectors - vectors, axis=0)
+        vectors, rewards, gram = new_vectors, new_rewards, new_gram
+        if(tol != None and not (adaptive and overshot.any()) and info["change"].max() < tol):
+            info["converged"][:] = True
+            break
+    return vectors, info
+
+
+#Largest factor by which adaptive=True grows the learning rate, and the relative drop of utility it tolerates as rounding
+_MAX_STEP_GROWTH = 1e6
+_UTILITY_SLACK = 1e-10
+
+
+def _utility(rewards, projections, projection_norms):
+    """
+    The EigenGame utility of a player: the variance it captures minus its alignment with its parents. It is computed in
+    float64 whatever the type of the data, so that the rounding of float32 does not pass for a drop of utility
+
+    :param rewards: (1D array), required: the projection data @ v of the player
+    :param projections: (2D array), required: the projections of its parents, stacked horizontally
+    :param projection_norms: (1D array), required: the squared norms of the projections of its parents
+    :return: float
+    """
+    rewards = rewards.astype(np.float64, copy=False)
+    alignments = np.dot(rewards, projections.astype(np.float64, copy=False))
+    return np.dot(rewards, rewards) - np.sum(alignments**2 / projection_norms)
+
+
+def _utilities(rewards):
+    """
+    The EigenGame utilities of all the players, from the Gram matrix of their projections (in float64). See _utility()
+    """
+    rewards = rewards.astype(np.float64, copy=False)
+    gram = np.dot(rewards.T, rewards)
+    return np.diag(gram) - np.sum(np.triu(gram**2 / np.diag(gram)[:, None], k=1), axis=0)
+
+
+def _convergence_info(n_components):
+    """
+    The convergence diagnostics of a fit: "n_iter" is the number of iterations run for every component, "converged"
+    whether its tolerance was reached and "change" the distance it moved in its last accepted iteration
+    """
+    return {"n_iter": np.zeros(n_components, dtype=int), "converged": np.zeros(n_components, dtype=bool),
+            "change": np.full(n_components, np.nan)}
+
+
+def _normalized_init(init, dim, n_components, dtype=np.float64):
+    """
+    Check the starting eigenvectors given for a warm start and return them normalized, stacked horizontally (features, n_components)
+    """
+    init = np.array(init, dtype=dtype).T
+    if(init.shape != (dim, n_components)):
+        raise ValueError(f"init must have shape {(n_components, dim)}, got {init.shape[::-1]}")
+    return init / np.linalg.norm(init, axis=0)
+
+
+def _initial_vectors(dim, n_components, dtype=np.float64):
+    """
+    Starting vectors of the players that update at the same time. They must not start from the same vector: their penalties
+    would then cancel their rewards exactly
+
+    :param dim: (int), required: the number of features
+    :param n_components: (int), required: the number of principal components to extract
+    :param dtype: (dtype), optional: the floating point type of the vectors. Default = np.float64
+    :return: orthonormal vectors, stacked horizontally (features, n_components)
+    """
+    return np.linalg.qr(np.ones((dim, n_components), dtype=dtype) + np.eye(dim, n_components, dtype=dtype))[0]
+
+
+def _stochastic_eigengame_step(batch, vectors, learning_rate):
+    """
+    _stochastic_eigengame_step is a helper function used by EigenGame.partial_fit() and should never be called outside
+    of it. It is the update of _parallel_eigengame() computed on a block of samples only. The update of every vector is
+    divided by its Rayleigh quotient on the block, so that the step does not depend on the scale of the data: with a
+    learning rate of 1 it is a step of power iteration, and smaller learning rates average the noise of the blocks out.
+
+    Parameters:
+    ----------------
+    :param batch: (2D array), required: a block of samples, in the form (samples, features)
+    :param vectors: (2D array), required: the current eigenvectors, stacked horizontally (features, n_components)
+    :param learning_rate: (float), required: the step size
+
+    Returns:
+    ----------------
+    :returns vectors: the updated eigenvectors, stacked horizontally (features, n_components)
+    :returns captured: the Rayleigh quotients ||batch @ v||^2 of the eigenvectors before the update
+    """
+    rewards = np.dot(batch, vectors)
+    moments = np.dot(batch.T, rewards)
+    gram = np.dot(vectors.T, moments)
+
+    #A vector that the block does not reach (e.g. rows of zeros) has a Rayleigh quotient of 0 and no update, its moments
+    #and Gram entries are 0 as well, so dividing by 1 instead leaves it (and its penalties on the others) unchanged
+    quotients = np.diag(gram)
+    divisors = np.where(quotients > 0, quotients, 1)
+    coefficients = np.triu(gram / divisors[:, None], k=1)
+    delta_v = moments - np.dot(moments, coefficients)
+    vectors = vectors + learning_rate * delta_v / divisors
+    return vectors / np.linalg.norm(vectors, axis=0), quotients
+
+
+def _randomized_pca(data, n_components, n_iter=4, oversamples=10, block_krylov=False, seed=None, init=None, dtype=None):
+    """
+    _randomized_pca is a helper function used by eigengame() and EigenGame and should never be called outside of them.
+    It finds the leading eigenvectors of data.T @ data in a few passes over data: a random sketch data @ omega of
+    n_components + oversamples columns spans the leading directions of the samples, n_iter power iterations sharpen it,
+    and the eigenvectors come from the SVD of the small projection of data on that basis. With block_krylov, the bases
+    of all the power iterations are kept and stacked (a block Krylov subspace), which is more accurate for the same number
+    of passes at the cost of a larger basis. data is read a block at a time (see _data_blocks), so it can be a np.memmap
+    larger than the memory.
+
+    Parameters:
+    ----------------
+    :param data: (2D array or np.memmap), required: the data array for which we want to run PCA on, in the form (samples, features)
+    :param n_components: (int), required: the number of principal components to extract
+    :param n_iter: (int), optional: the number of power iterations, each is two passes over data. Default = 4
+    :param oversamples: (int), optional: the number of extra columns of the sketch. Default = 10
+    :param block_krylov: (bool), optional: keep the bases of all the iterations. Default = False
+    :param seed: (int), optional: seed of the random sketch. Default = None
+    :param init: (2D array), optional: eigenvectors (n_components, features) that start the sketch, the oversamples stay random.
+                 Default = None
+    :param dtype: (dtype), optional: the floating point type of the computations. Default = None, that of data
+
+    Returns:
+    ----------------
+    :returns vectors: the eigenvectors, stacked horizontally (features, n_components)
+    :returns info: the convergence diagnostics, see _convergence_info(). n_iter is the number of power iterations
+
+    References:
+    ----------------
+    "Finding structure with randomness: Probabilistic algorithms for constructing approximate matrix decompositions";
+    Halko et al., 2011
+    "Randomized Block Krylov Methods for Stronger and Faster Approximate Singular Value Decomposition"; Musco & Musco, 2015
+    """
+    dtype = _float_dtype(data, dtype)
+    dim = data.shape[1]
+    size = min(n_components + oversamples, *data.shape)
+    omega = np.random.default_rng(seed).standard_normal((dim, size), dtype=np.float64).astype(dtype)
+    if init is not None:
+        omega[:, :n_components] = _normalized_init(init, dim, n_components, dtype)
+
+    basis = np.linalg.qr(_dot(data, omega, dtype))[0]
+    bases = [basis]
+    for iteration in range(n_iter):
+        #The QR of every half step keeps the small singular values from being rounded away
+        basis = np.linalg.qr(_dot(data, np.linalg.qr(_tdot(data, basis, dtype))[0], dtype))[0]
+        bases.append(basis)
+    if block_krylov:
+        basis = np.linalg.qr(np.hstack(bases))[0]
+
+    #The right singular vectors of basis.T @ data are the left ones of its transpose, which is (features, size)
+    vectors = np.linalg.svd(_tdot(data, basis, dtype), full_matrices=False)[0][:, :n_components]
+    info = _convergence_info(n_components)
+    info["n_iter"][:] = n_iter
+    return vectors, info
+
+
+#Number of values of data that the randomized solvers and EigenGame.fit_transform() read at a time
+_PCA_BLOCK_ELEMENTS = 2**22
+
+
+def _data_blocks(data, dtype):
+    """
+    Split data into blocks of about _PCA_BLOCK_ELEMENTS values along its contiguous axis: rows for C-ordered data, columns
+    for the transpose of C-ordered data (as fit_transform() makes of its (features, samples) input), so that every
+    block of a np.memmap is a contiguous part of its file
+
+    :return: generator of (axis, slice, block): the axis split, the rows or columns of the block, and the block in type dtype
+    """
+    axis = 1 if (data.flags.f_contiguous and not data.flags.c_contiguous) else 0
+    step = max(1, _PCA_BLOCK_ELEMENTS // max(1, data.shape[1 - axis]))
+    for start in range(0, data.shape[axis], step):
+        part = slice(start, start + step)
+        block = data[part] if axis == 0 else data[:, part]
+        yield axis, part, np.asarray(block).astype(dtype, copy=False)
+
+
+def _dot(data, matrix, dtype):
+    """
+    data @ matrix, reading data a block at a time
+    """
+    product = np.zeros((data.shape[0], matrix.shape[1]), dtype=dtype)
+    for axis, part, block in _data_blocks(data, dtype):
+        if axis == 0:
+            product[part] = np.dot(block, matrix)
+        else:
+            product += np.dot(block, matrix[part])
+    return product
+
+
+def _tdot(data, matrix, dtype):
+    """
+    data.T @ matrix, reading data a block at a time
+    """
+    product = np.zeros((data.shape[1], matrix.shape[1]), dtype=dtype)
+    for axis, part, block in _data_blocks(data, dtype):
+        if axis == 0:
+            product += np.dot(block.T, matrix[part])
+        else:
+            product[part] = np.dot(block.T, matrix)
+    return product
+
+
+def _project(data, vectors, dtype):
+    """
+    The projections data @ vectors and the squared Frobenius norm of data (in float64), in one pass over data
+    """
+    projections = np.zeros((data.shape[0], vectors.shape[1]), dtype=dtype)
+    total = 0.0
+    for axis, part, block in _data_blocks(data, dtype):
+        total += np.einsum("ij,ij->", block, block, dtype=np.float64)
+        if axis == 0:
+            projections[part] = np.dot(block, vectors)
+        else:
+            projections += np.dot(block, vectors[part])
+    return projections, total
+
+
+#The update schemes of the eigengame solver, and the solvers, accepted by EigenGame and eigengame()
+_UPDATES = {"sequential": _sequential_eigengame, "parallel": _parallel_eigengame}
+_SOLVERS = ("eigengame", "randomized", "block_krylov")
+
+
+def _check_update(update):
+    if update not in _UPDATES:
+        raise ValueError(f"update must be one of {tuple(_UPDATES)}, got {update!r}")
+
+
+def _check_solver(solver):
+    if solver not in _SOLVERS:
+        raise ValueError(f"solver must be one of {_SOLVERS}, got {solver!r}")
+
+
+def _fit(data, n_components, epochs, learning_rate, update, tol, adaptive, init, solver, n_iter, oversamples, seed, dtype):
+    """
+    Run the solver chosen for eigengame() or EigenGame.fit_transform() on data (samples, features)
+
+    :return: the eigenvectors (features, n_components), the convergence diagnostics, and data as it was used: cast to dtype
+             for the eigengame solver, as it is for the randomized ones, which cast it a block at a time
+    """
+    dtype = _float_dtype(data, dtype)
+    if solver == "eigengame":
+        data = data.astype(dtype, copy=False)
+        vectors, info = _UPDATES[update](data, n_components, epochs, learning_rate, tol, adaptive, init)
+        _warn_not_converged(info, tol)
+    else:
+        vectors, info = _randomized_pca(data, n_components, n_iter, oversamples, solver == "block_krylov", seed, init, dtype)
+    return vectors, info, data
+
+
+def _warn_not_converged(info, tol):
+    """
+    Warn about the components that did not reach the tolerance within the allowed epochs
+    """
+    if(tol != None and not info["converged"].all()):
+        missing = np.flatnonzero(~info["converged"]).tolist()
+        warnings.warn(f"EigenGame components {missing} did not converge to tol={tol}, increase epochs or learning_rate", RuntimeWarning)
+
+
 class EigenGame():
-    def __init__(self, n_components, epochs=100, learning_rate=0.1):
+    def __init__(self, n_components, epochs=100, learning_rate=0.1, update="sequential", tol=None, adaptive=False, dtype=None,
+                 solver="eigengame", n_iter=4, oversamples=10, seed=None):
         
         """
         EigenGame implements the "EigenGame" algorithm, developed by
@@ -40,8 +420,35 @@ class EigenGame():
         ----------------
         :param data: (2D array), required: a Numpy array containing the data to run PCA on, in the form (features, samples) 
         :param n_components: (int), required: the number of principal components to extract
-        :param epochs: (int), optional: the number of iterations to calculate each eigenvector. Default = 100
+        :param epochs: (int), optional: the (maximum) number of iterations to calculate each eigenvector. Default = 100
         :param learning_rate: (float), optional: Learning rate of the algorithm. Default = 0.1
+        :param update: (string), optional: "sequential" learns the components one after the other, "parallel" updates all of them
+                       at once with a few matrix products per epoch. Default = "sequential"
+        :param tol: (float), optional: a component stops early once its eigenvector moves by less than tol (in norm) in an
+                    iteration. A warning is raised for the components that do not reach it within epochs. Default = None,
+                    every component runs all the epochs
+        :param adaptive: (bool), optional: grow the learning rate of a component while its utility increases and halve it
+                         (retrying the step) when the utility drops, so that the learning rate does not depend on the scale
+                         of the data. Default = False
+        :param dtype: (dtype), optional: the floating point type the data is processed in, e.g. np.float32 to halve the memory
+                      and bandwidth of float64 data. Default = None, the type of the data (float64 for integer data), so that
+                      float32 data is never copied to float64
+        :param solver: (string), optional: "eigengame" for the EigenGame algorithm, "randomized" for a randomized range finder
+                       with power iterations, or "block_krylov" for a randomized block Krylov method. The randomized solvers
+                       need only 2 * n_iter + 3 passes over the data (read a block at a time, so a np.memmap larger than
+                       the memory works), and ignore epochs, learning_rate, update, tol and adaptive. Default = "eigengame"
+        :param n_iter: (int), optional: the number of power iterations of the randomized solvers. Default = 4
+        :param oversamples: (int), optional: the number of extra random directions of the randomized solvers. Default = 10
+        :param seed: (int), optional: seed of the randomized solvers. Default = None
+
+        After a fit, explained_variance_ holds the variance captured by every principal component (||data @ v||^2 / (n_samples - 1),
+        the data is not centered) and explained_variance_ratio_ its fraction of the total variance. They are computed from
+        the projections of the fit, without another pass over the data. After partial_fit() they are estimates summed over
+        the blocks seen (over the last pass for fit_stream()). After fit_transform(), n_iter_, converged_ and change_ hold the number of iterations run for every component,
+        whether it reached tol and how much its eigenvector moved in its last iteration.
+
+        Data that does not fit in memory can be streamed in blocks of samples with partial_fit() or fit_stream() instead of
+        fit_transform()
 
         Returns:
         ----------------
@@ -55,15 +462,32 @@ class EigenGame():
         self.n_components = n_components
         self.epochs = epochs
         self.learning_rate = learning_rate
+        _check_update(update)
+        self.update = update
+        self.tol = tol
+        self.adaptive = adaptive
+        self.dtype = dtype
+        _check_solver(solver)
+        self.solver = solver
+        self.n_iter = n_iter
+        self.oversamples = oversamples
+        self.seed = seed
+        self.n_batches_seen = 0
+        self.n_samples_seen = 0
+        self._reset_explained_variance()
     
-    def fit_transform(self, data):
+    def fit_transform(self, data, init=None):
         """
         fit_transform() performs PCA on input data using the "EigenGame" algorithm, developed by
         Gemp et al. in 2020
 
         Parameters:
         ----------------
-        None
+        :param data: (2D array), required: a Numpy array containing the data to run PCA on, in the form (features, samples),
+                     or a np.memmap of it (e.g. np.load(path, mmap_mode="r").T) for the randomized solvers
+        :param init: (2D array), optional: eigenvectors to start from (n_components, features), e.g. the eigenvectors of a
+                     previous fit on a slightly different cohort. With tol, a warm start finishes in a few iterations.
+                     Default = None
         
         Returns:
         ----------------
@@ -73,48 +497,117 @@ class EigenGame():
         References:
         ----------------
         "EigenGame: PCA as a Nash Equilibrium"; Gemp et al., 2020 
+        "Finding structure with randomness: Probabilistic algorithms for constructing approximate matrix decompositions";
+        Halko et al., 2011
         """
-        data = data.T
+        data = np.asanyarray(data).T
+        vectors, info, data = _fit(data, self.n_components, self.epochs, self.learning_rate, self.update, self.tol,
+                                   self.adaptive, init, self.solver, self.n_iter, self.oversamples, self.seed, self.dtype)
         self.data = data
+        self.n_iter_ = info["n_iter"]
+        self.converged_ = info["converged"]
+        self.change_ = info["change"]
 
-        n_components = self.n_components
-        learning_rate = self.learning_rate
-        epochs = self.epochs
-        
-        dim = data.shape[1]
-        vectors = np.ones((dim, n_components))
-        for t in range(n_components):
-            for epoch in range(epochs):
-                rewards = np.dot(data, vectors[:, t])
-                penalties = calc_penalties(data, vectors, t)
+        self.eigenvectors = vectors.T
+        self.components, total = _project(data, vectors, vectors.dtype)
+        self._set_explained_variance(np.einsum("ij,ij->j", self.components, self.components, dtype=np.float64),
+                                     total, data.shape[0])
+        return vectors
 
-                delta_v = 2*np.dot(data.T, rewards - penalties)
-                vectors[:, t] = vectors[:, t] + learning_rate * delta_v
-                vectors[:, t] = vectors[:, t] / np.linalg.norm(vectors[:, t])
+    def partial_fit(self, batch, learning_rate=None):
+        """
+        partial_fit() updates the eigenvectors with one stochastic step of all the components at once on a block of samples,
+        so that data that does not fit in memory can be streamed through the model. Only the eigenvectors are kept between
+        the calls, the first call starts them. The data is not centered.
+
+        Parameters:
+        ----------------
+        :param batch: (2D array), required: a block of samples, in the form (samples, features). Unlike fit_transform(), the
+                      samples are the rows, so that row blocks of a large np.memmap can be passed as they are
+        :param learning_rate: (float), optional: The step size. Default = None, 1 / (1 + n / 10) after n blocks, which
+                              averages the noise of the blocks out as more of them are seen
+
+        Returns:
+        ----------------
+        self
+        """
+        if self.solver != "eigengame":
+            raise ValueError(f"partial_fit() needs solver='eigengame', got {self.solver!r}")
+        batch = np.asarray(batch)
+        if self.n_batches_seen == 0:
+            dtype = _float_dtype(batch, self.dtype)
+            self.eigenvectors = _initial_vectors(batch.shape[1], self.n_components, dtype).T
+        batch = batch.astype(self.eigenvectors.dtype, copy=False)
+        self.n_batches_seen += 1
+        if(learning_rate == None):
+            learning_rate = 1 / (1 + self.n_batches_seen / 10)
 
+        vectors, captured = _stochastic_eigengame_step(batch, self.eigenvectors.T, learning_rate)
         self.eigenvectors = vectors.T
-        self.components = data @ self.eigenvectors.T
-        return vectors
+        self.n_samples_seen += batch.shape[0]
+
+        #The variance explained is summed over the blocks, each with the eigenvectors of the time it was seen
+        self._captured_variance = self._captured_variance + captured
+        self._total_variance += np.einsum("ij,ij->", batch, batch, dtype=np.float64)
+        self._variance_samples += batch.shape[0]
+        self._set_explained_variance(self._captured_variance, self._total_variance, self._variance_samples)
+        return self
+
+    def fit_stream(self, data, batch_size=256, epochs=1):
+        """
+        fit_stream() performs PCA on data that is read one block of samples at a time with partial_fit(), so the memory used
+        does not grow with the number of samples. Unlike fit_transform(), the components of the samples are not computed
+
+        Parameters:
+        ----------------
+        :param data: (2D array, np.memmap or iterable), required: the samples in the form (samples, features), or an iterable
+                     of such blocks of samples (e.g. a generator reading them from disk)
+        :param batch_size: (int), optional: the number of samples per block when data is an array. Default = 256
+        :param epochs: (int), optional: the number of passes over data when it is an array. An iterable is only read once.
+                       Default = 1
+
+        Returns:
+        ----------------
+        vectors
+        :returns vectors: the principal components, stacked horizontally
+        """
+        if isinstance(data, np.ndarray):
+            for epoch in range(epochs):
+                #The explained variance is estimated on the last pass, with the most settled eigenvectors
+                self._reset_explained_variance()
+                for start in range(0, data.shape[0], batch_size):
+                    self.partial_fit(data[start:start + batch_size])
+        else:
+            for batch in data:
+                self.partial_fit(batch)
+        return self.eigenvectors.T
     
     def get_explained_variance_ratio(self):
-        explained_variance_ratios = []
-        
-        cov_matrix_firstrow = np.zeros((self.data.shape[1]))
-        for i in range(self.data.shape[1]):
-            cov_matrix_firstrow[i] = np.dot(self.data[:,0], self.data[:,i])
-        
-        
-        for v in self.eigenvectors:
-            explained_variance_ratios.append(np.dot(v, cov_matrix_firstrow) / v[0])
-        
-        covariance_matrix_trace = 0
-        for row in self.data:
-            covariance_matrix_trace += np.dot(row, row)
-        
-        return explained_variance_ratios / covariance_matrix_trace
+        """
+        Return the fraction of the total variance of the data that every principal component explains, see explained_variance_ratio_
+        """
+        return self.explained_variance_ratio_
+
+    def _reset_explained_variance(self):
+        """
+        Start summing the explained variance of the blocks given to partial_fit() again
+        """
+        self._captured_variance = np.zeros(self.n_components)
+        self._total_variance = 0.0
+        self._variance_samples = 0
+
+    def _set_explained_variance(self, captured, total, n_samples):
+        """
+        Set explained_variance_ and explained_variance_ratio_ from the Rayleigh quotients ||data @ v||^2 of the eigenvectors
+        and the squared Frobenius norm of the data (the trace of its covariance matrix)
+        """
+        self.explained_variance_ = captured / max(n_samples - 1, 1)
+        #no variance seen yet (only blocks of zeros), so nothing is explained
+        self.explained_variance_ratio_ = captured / total if total > 0 else np.zeros(len(captured))
 
      
-def eigengame(data, n_components, epochs=100, learning_rate=0.1):
+def eigengame(data, n_components, epochs=100, learning_rate=0.1, update="sequential", tol=None, adaptive=False, init=None,
+              return_info=False, dtype=None, solver="eigengame", n_iter=4, oversamples=10, seed=None):
     """
     eigengame() performs PCA on input data using the "EigenGame" algorithm, developed by
     Gemp et al. in 2020
@@ -123,18 +616,54 @@ def eigengame(data, n_components, epochs=100, learning_rate=0.1):
     ----------------
     :param data: (2D array), required: a Numpy array containing the data to run PCA on, in the form (features, samples) 
     :param n_components: (int), required: the number of principal components to extract
-    :param epochs: (int), optional: the number of iterations to calculate each eigenvector. Default = 100
+    :param epochs: (int), optional: the (maximum) number of iterations to calculate each eigenvector. Default = 100
     :param learning_rate: (float), optional: Learning rate of the algorithm. Default = 0.1
+    :param update: (string), optional: "sequential" learns the components one after the other, "parallel" updates all of them
+                   at once with a few matrix products per epoch. Default = "sequential"
+    :param tol: (float), optional: a component stops early once its eigenvector moves by less than tol in an iteration,
+                see EigenGame. Default = None
+    :param adaptive: (bool), optional: adapt the learning rate of every component to its utility, see EigenGame. Default = False
+    :param init: (2D array), optional: eigenvectors to start from (n_components, features). Default = None
+    :param return_info: (bool), optional: also return the convergence diagnostics. Default = False
+    :param dtype: (dtype), optional: the floating point type the data is processed in, see EigenGame. Default = None, the
+                  type of the data
+    :param solver: (string), optional: "eigengame", "randomized" or "block_krylov", see EigenGame. Default = "eigengame"
+    :param n_iter: (int), optional: the number of power iterations of the randomized solvers. Default = 4
+    :param oversamples: (int), optional: the number of extra random directions of the randomized solvers. Default = 10
+    :param seed: (int), optional: seed of the randomized solvers. Default = None
     
     Returns:
     ----------------
-    vectors
+    vectors (, info)
     :returns vectors: the principal components, stacked horizontally
+    :returns info: (dict) only if return_info: "n_iter", "converged" and "change" arrays with the number of iterations run
+                   for every component, whether it reached tol and how much it moved in its last iteration
     
     References:
     ----------------
     "EigenGame: PCA as a Nash Equilibrium"; Gemp et al., 2020 
     """
+    _check_update(update)
+    _check_solver(solver)
+    vectors, info, data = _fit(np.asanyarray(data), n_components, epochs, learning_rate, update, tol, adaptive, init, solver,
+                               n_iter, oversamples, seed, dtype)
+    if return_info:
+        return vectors.T, info
+    return vectors.T
+
+
+# slower implementations for testing
+def _loop_eigengame(data, n_components, epochs=100, learning_rate=0.1):
+    """
+    Original sequential eigengame() that recomputes the penalties of every earlier vector with calc_penalties at every
+    epoch. For comparison with the faster implementations.
+
+    :param data: (2D array), required: the data array for which we want to run PCA on, in the form (samples, features)
+    :param n_components: (int), required: the number of principal components to extract
+    :param epochs: (int), optional: the number of iterations to calculate each eigenvector. Default = 100
+    :param learning_rate: (float), optional: Learning rate of the algorithm. Default = 0.1
+    :return: the eigenvectors, stacked vertically (n_components, features)
+    """
     dim = data.shape[1]
     vectors = np.ones((dim, n_components))
     for t in range(n_components):
@@ -147,3 +676,29 @@ def eigengame(data, n_components, epochs=100, learning_rate=0.1):
             vectors[:, t] = vectors[:, t] / np.linalg.norm(vectors[:, t])
             
     return vectors.T
+
+
+def _loop_explained_variance_ratio(data, eigenvectors):
+    """
+    Original EigenGame.get_explained_variance_ratio(), which builds the first row of the covariance matrix and its trace
+    with Python loops. For comparison with explained_variance_ratio_.
+
+    :param data: (2D array), required: the data, in the form (samples, features)
+    :param eigenvectors: (2D array), required: the eigenvectors, stacked vertically (n_components, features)
+    :return: the explained variance ratio of every eigenvector
+    """
+    explained_variance_ratios = []
+    
+    cov_matrix_firstrow = np.zeros((data.shape[1]))
+    for i in range(data.shape[1]):
+        cov_matrix_firstrow[i] = np.dot(data[:,0], data[:,i])
+    
+    
+    for v in eigenvectors:
+        explained_variance_ratios.append(np.dot(v, cov_matrix_firstrow) / v[0])
+    
+    covariance_matrix_trace = 0
+    for row in data:
+        covariance_matrix_trace += np.dot(row, row)
+    
+    return explained_variance_ratios / covariance_matrix_trace
@@ -0,0 +1,542 @@
+"""
+Benchmarks for NeuralABC_tools. Run the suite (wall time and peak memory of every hot path, across input sizes and
+core counts, checked against the _loop_* reference implementations) with:
+
+    python -m NeuralABC_tools.tests.benchmarks --sizes small mni2mm --save results.json
+    python -m NeuralABC_tools.tests.benchmarks --sizes small mni2mm --compare results.json
+
+and the comparisons of the current implementations with the ones they replaced with --comparisons.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from ..Parallelize import Parallelize
+from ..arrays import (map_vals_to_index, LabelIndex, bin_statistics_by_index, parcellate, _binned_statistic_by_index,
+                      _loop_map_vals_to_index, _loop_mean_statistics_by_index)
+from ..conv_functions import linreg, _loop_linreg
+from ..eigengame import EigenGame, eigengame, _loop_eigengame
+
+
+def _skewed_cost(cost):
+    # sleeping stands in for a subject that takes `cost` seconds to process
+    time.sleep(cost)
+    return cost
+
+
+def bench_parallelize_skewed(num_subjects=200, num_cores=None, heavy_fraction=0.125, light=0.002, heavy=0.04):
+    """
+    Compare the idle time of a static split (one contiguous range per core, as Parallelize used to do) with the dynamic
+    chunk scheduling on a workload where the expensive subjects are all at the start of the data.
+
+    Idle time is the fraction of (wall time * num_cores) during which a core had nothing to do.
+
+    :return: dict mapping the scheduling strategy to (wall time in s, idle fraction)
+    """
+    if num_cores is None:
+        num_cores = multiprocessing.cpu_count()
+    num_cores = min(num_cores, multiprocessing.cpu_count())
+
+    costs = np.full(num_subjects, light)
+    costs[:int(num_subjects * heavy_fraction)] = heavy
+    total_work = costs.sum()
+
+    strategies = {"static": int(np.ceil(num_subjects / num_cores)), "dynamic (default)": None, "dynamic (chunksize=1)": 1}
+    results = {}
+    for name, chunksize in strategies.items():
+        start = time.perf_counter()
+        Parallelize(costs, _skewed_cost, num_cores, chunksize=chunksize)
+        wall = time.perf_counter() - start
+        results[name] = (wall, 1 - total_work / (wall * num_cores))
+    return results
+
+
+def _max_angle(vectors, reference):
+    # largest angle (degrees) between matching components, ignoring their sign
+    cosines = np.abs(np.sum(vectors * reference, axis=1)) / np.linalg.norm(vectors, axis=1)
+    return np.degrees(np.arccos(np.clip(cosines, 0, 1))).max()
+
+
+def bench_eigengame(n_samples=500, n_features=5000, n_components=10, epochs=100, seed=0):
+    """
+    Compare the EigenGame update schemes with an exact SVD and, when scikit-learn is installed, its PCA, on data with a
+    decaying spectrum.
+
+    :return: dict mapping the solver to (wall time in s, largest angle in degrees to the SVD components)
+    """
+    rng = np.random.default_rng(seed)
+    rank = 4 * n_components
+    left = np.linalg.qr(rng.standard_normal((n_samples, rank)))[0]
+    right = np.linalg.qr(rng.standard_normal((n_features, rank)))[0]
+    data = left @ np.diag(np.geomspace(10, 0.1, rank)) @ right.T + 0.01 * rng.standard_normal((n_samples, n_features))
+
+    solvers = {
+        "np.linalg.svd": lambda: np.linalg.svd(data, full_matrices=False)[2][:n_components],
+        "eigengame (loop)": lambda: _loop_eigengame(data, n_components, epochs),
+        "eigengame (sequential)": lambda: eigengame(data, n_components, epochs),
+        "eigengame (parallel)": lambda: eigengame(data, n_components, epochs, update="parallel"),
+    }
+    try:
+        from sklearn.decomposition import PCA
+        # eigengame does not center the data, so neither does the reference
+        solvers["sklearn PCA"] = lambda: PCA(n_components).fit(data - data.mean(axis=0)).components_
+    except ImportError:
+        pass
+
+    results = {}
+    reference = None
+    for name, solve in solvers.items():
+        start = time.perf_counter()
+        vectors = solve()
+        wall = time.perf_counter() - start
+        if reference is None:
+            reference = vectors
+        results[name] = (wall, _max_angle(vectors, reference))
+    return results
+
+
+def bench_linreg(num_subjects=100, num_iv=10, num_dv=200, num_cov=2, seed=0):
+    """
+    Compare linreg(), with and without residualizing the covariates once, with the pingouin loop it replaces
+    (_loop_linreg) on random data with covariates.
+
+    :return: dict mapping the implementation to (wall time in s, largest absolute difference of the t-values to the loop)
+    """
+    rng = np.random.default_rng(seed)
+    iv = rng.standard_normal((num_subjects, num_iv))
+    dv = rng.standard_normal((num_subjects, num_dv))
+    cov = rng.standard_normal((num_subjects, num_cov))
+
+    results = {}
+    reference = None
+    implementations = {
+        "pingouin loop": _loop_linreg,
+        "linreg (residualize=False)": lambda *args, **kwargs: linreg(*args, residualize=False, **kwargs),
+        "linreg": linreg,
+    }
+    for name, run in implementations.items():
+        start = time.perf_counter()
+        tvalues = np.array(list(run(iv, dv, cov, verbose=0)["t_values"].values()))
+        wall = time.perf_counter() - start
+        if reference is None:
+            reference = tvalues
+        results[name] = (wall, np.abs(tvalues - reference).max())
+    return results
+
+
+def bench_pca_solvers(n_samples=1001, n_features=20000, n_components=10, epochs=100, seed=0):
+    """
+    Compare the randomized solvers with EigenGame on a (samples, features) matrix like the cohort matrices of the lab
+    (1001 X 119387, pass n_features=119387 to reproduce it), in memory and as a float32 np.memmap read a block at a time.
+
+    :return: dict mapping the solver to (wall time in s, largest angle in degrees to the SVD components)
+    """
+    rng = np.random.default_rng(seed)
+    rank = 4 * n_components
+    left = np.linalg.qr(rng.standard_normal((n_samples, rank)))[0]
+    right = np.linalg.qr(rng.standard_normal((n_features, rank)))[0]
+    data = left @ np.diag(np.geomspace(10, 0.1, rank)) @ right.T + 0.01 * rng.standard_normal((n_samples, n_features))
+    data = data.astype(np.float32)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "data.npy")
+        np.save(path, data)
+        memmap = np.load(path, mmap_mode="r")
+        solvers = {
+            "np.linalg.svd (float64)": lambda: np.linalg.svd(data.astype(np.float64), full_matrices=False)[2][:n_components],
+            "eigengame (sequential)": lambda: eigengame(data, n_components, epochs),
+            "eigengame (parallel)": lambda: eigengame(data, n_components, epochs, update="parallel"),
+            "randomized (n_iter=2)": lambda: eigengame(data, n_components, solver="randomized", n_iter=2, seed=seed),
+            "randomized": lambda: eigengame(data, n_components, solver="randomized", seed=seed),
+            "block_krylov (n_iter=2)": lambda: eigengame(data, n_components, solver="block_krylov", n_iter=2, seed=seed),
+            "randomized (memmap)": lambda: eigengame(memmap, n_components, solver="randomized", seed=seed),
+        }
+        reference = None
+        for name, solve in solvers.items():
+            start = time.perf_counter()
+            vectors = solve()
+            wall = time.perf_counter() - start
+            if reference is None:
+                reference = vectors
+            results[name] = (wall, _max_angle(vectors.astype(np.float64), reference.astype(np.float64)))
+    return results
+
+
+def _per_subject_mean(path, atlas):
+    # the previous workflow: every subject runs its own unique/sort of the atlas through scipy
+    return _binned_statistic_by_index(atlas, np.load(path))["stat"]
+
+
+def bench_parcellate(num_subjects=40, shape=(91, 109, 91), num_regions=200, num_cores=None, seed=0):
+    """
+    Parcellate a synthetic cohort of .npy volumes with parcellate(), and with Parallelize() over a per-subject
+    scipy.stats.binned_statistic as before.
+
+    :return: dict mapping the pipeline to (wall time in s, subjects per second)
+    """
+    if num_cores is None:
+        num_cores = multiprocessing.cpu_count()
+    rng = np.random.default_rng(seed)
+    atlas = rng.integers(0, num_regions + 1, shape)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for subject in range(num_subjects):
+            paths.append(os.path.join(directory, f"sub-{subject}.npy"))
+            np.save(paths[-1], rng.random(shape, dtype=np.float32))
+
+        pipelines = {
+            "Parallelize + binned_statistic": lambda: Parallelize(paths, lambda path: _per_subject_mean(path, atlas), num_cores, backend="thread"),
+            "parcellate": lambda: parcellate(paths, atlas, "mean", num_cores=num_cores),
+            "parcellate (6 statistics)": lambda: parcellate(paths, atlas, ["mean", "std", "count", "sum", "min", "max"], num_cores=num_cores),
+        }
+        for name, run in pipelines.items():
+            start = time.perf_counter()
+            run()
+            wall = time.perf_counter() - start
+            results[name] = (wall, num_subjects / wall)
+    return results
+
+
+def _import_time(statement, repeats):
+    # best wall time of running the statement in a fresh interpreter, minus the start-up of an empty one
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ, PYTHONPATH=root)
+    times = []
+    for code in ("pass", statement):
+        best = np.inf
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], env=env, check=True)
+            best = min(best, time.perf_counter() - start)
+        times.append(best)
+    return times[1] - times[0]
+
+
+def bench_import_time(repeats=5):
+    """
+    Time the import of the package and of Parallelize alone against the eager import of every submodule and scipy.stats,
+    which is what importing the package used to cost, each in a fresh interpreter.
+
+    :return: dict mapping the import to its time in s
+    """
+    statements = {"import NeuralABC_tools": "import NeuralABC_tools",
+                  "from NeuralABC_tools import Parallelize": "from NeuralABC_tools import Parallelize",
+                  "eager (previous package import)":
+                      "import scipy.stats; from NeuralABC_tools import arrays, conv_functions, eigengame, Parallelize"}
+    return {name: _import_time(statement, repeats) for name, statement in statements.items()}
+
+
+#Input sizes of the suite. mni2mm is a 2 mm MNI volume with a 400 region atlas, and a cohort matrix of 20000 features.
+#The _loop_* oracles are too slow for it, so its results are checked against the single core vectorized runs instead
+SIZES = {
+    "tiny": dict(volume=(12, 14, 12), regions=10, subjects=20, features=200, components=3, ivs=2, dvs=10, oracles=True),
+    "small": dict(volume=(45, 54, 45), regions=100, subjects=60, features=2000, components=5, ivs=5, dvs=300, oracles=True),
+    "mni2mm": dict(volume=(91, 109, 91), regions=400, subjects=200, features=20000, components=10, ivs=10, dvs=20000,
+                   oracles=False),
+}
+
+
+def _measure(run, repeats):
+    """
+    Time run() and measure the peak of the memory it allocates. The wall time is the best of repeats runs, the peak
+    memory comes from one more run traced with tracemalloc (which numpy reports its buffers to), as tracing slows the
+    Python level loops down. The memory of worker processes is not included.
+
+    :return: (output of run(), wall time in s, peak memory in bytes)
+    """
+    wall = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = run()
+        wall = min(wall, time.perf_counter() - start)
+    del output
+    tracemalloc.start()
+    try:
+        output = run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return output, wall, peak
+
+
+def _record(benchmark, case, size, cores, run, reference=None, error=None, repeats=3):
+    """
+    Measure run() into a result record of the suite. error(output, reference) gives the difference of the output to
+    the reference (an oracle or a reference run), when there is one.
+
+    :param repeats: (int) number of timed runs, 1 for the slow oracles
+    :return: (record dict, output of run())
+    """
+    output, wall, peak = _measure(run, repeats)
+    record = {"benchmark": benchmark, "case": case, "size": size, "cores": cores, "wall": wall, "peak_memory": peak,
+              "error": None if reference is None or error is None else float(error(output, reference))}
+    return record, output
+
+
+def _max_difference(output, reference):
+    return np.nanmax(np.abs(np.asarray(output, dtype=np.float64) - np.asarray(reference, dtype=np.float64)))
+
+
+def _core_counts(core_counts):
+    # powers of two up to the number of cores, and the number of cores
+    available = multiprocessing.cpu_count()
+    if core_counts is None:
+        core_counts = sorted({2**power for power in range(available.bit_length()) if 2**power <= available} | {available})
+    return [cores for cores in core_counts if cores <= available]
+
+
+def _cohort(spec, rng):
+    # subjects X features, with a decaying spectrum so that the leading components are well separated
+    rank = 4 * spec["components"]
+    left = np.linalg.qr(rng.standard_normal((spec["subjects"], rank)))[0]
+    right = np.linalg.qr(rng.standard_normal((spec["features"], rank)))[0]
+    noise = 0.01 * rng.standard_normal((spec["subjects"], spec["features"]))
+    return (left @ np.diag(np.geomspace(10, 0.1, rank)) @ right.T + noise).astype(np.float32)
+
+
+def _atlas(spec, rng):
+    return rng.integers(0, spec["regions"] + 1, spec["volume"])
+
+
+def _row_summary(row):
+    # a per-subject workload: a few order statistics of a feature vector
+    return np.percentile(row, [5, 50, 95])
+
+
+def suite_parallelize(size, spec, core_counts, rng):
+    """
+    Parallelize() over the rows of the cohort matrix, on the process and thread backends, against a list comprehension
+    """
+    data = _cohort(spec, rng)
+    oracle = lambda: np.array([_row_summary(row) for row in data])
+    record, reference = _record("Parallelize", "list comprehension", size, 1, oracle, repeats=1)
+    records = [record]
+    for cores in core_counts:
+        for backend in ("process", "thread"):
+            run = lambda: Parallelize(data, _row_summary, cores, backend=backend)
+            records.append(_record("Parallelize", f"backend={backend}", size, cores, run, reference, _max_difference)[0])
+    return records
+
+
+def suite_eigengame(size, spec, core_counts, rng):
+    """
+    eigengame() and EigenGame.fit_transform() against the SVD, and the _loop_eigengame oracle. The error is the largest
+    angle in degrees between the components and those of the SVD
+    """
+    data = _cohort(spec, rng).astype(np.float64)
+    k = spec["components"]
+    angle = lambda vectors, reference: _max_angle(vectors, reference)
+    record, reference = _record("eigengame", "np.linalg.svd", size, 1, lambda: np.linalg.svd(data, full_matrices=False)[2][:k])
+    records = [record]
+    runs = {"eigengame (sequential)": lambda: eigengame(data, k),
+            "eigengame (parallel)": lambda: eigengame(data, k, update="parallel"),
+            "EigenGame.fit_transform": lambda: EigenGame(k).fit_transform(data.T).T,
+            "eigengame (randomized)": lambda: eigengame(data, k, solver="randomized", seed=0),
+            "eigengame (block_krylov)": lambda: eigengame(data, k, solver="block_krylov", seed=0)}
+    for case, run in runs.items():
+        records.append(_record("eigengame", case, size, 1, run, reference, angle)[0])
+    if spec["oracles"]:
+        records.append(_record("eigengame", "_loop_eigengame", size, 1, lambda: _loop_eigengame(data, k), reference, angle, repeats=1)[0])
+    return records
+
+
+def suite_linreg(size, spec, core_counts, rng):
+    """
+    linreg() on n_jobs threads against the pingouin loop (_loop_linreg) oracle, or the single thread run without oracles.
+    The error is the largest difference of the t-values
+    """
+    subjects = spec["subjects"]
+    iv = rng.standard_normal((subjects, spec["ivs"]))
+    dv = rng.standard_normal((subjects, spec["dvs"]))
+    cov = rng.standard_normal((subjects, 2))
+    records = []
+    reference = None
+    if spec["oracles"]:
+        oracle = lambda: np.array(list(_loop_linreg(iv, dv, cov, verbose=0)["t_values"].values()))
+        record, reference = _record("linreg", "_loop_linreg", size, 1, oracle, repeats=1)
+        records.append(record)
+    for cores in core_counts:
+        run = lambda: linreg(iv, dv, cov, verbose=0, save_res=False, n_jobs=cores, output="arrays")["t_values"]
+        record, tvalues = _record("linreg", "linreg", size, cores, run, reference, _max_difference)
+        reference = tvalues if reference is None else reference
+        records.append(record)
+    return records
+
+
+def suite_map_vals_to_index(size, spec, core_counts, rng):
+    """
+    map_vals_to_index() and the map() of a prebuilt LabelIndex against the _loop_map_vals_to_index oracle
+    """
+    atlas = _atlas(spec, rng)
+    key_vals = rng.random(np.unique(atlas).size)
+    index = LabelIndex(atlas)
+    runs = {"map_vals_to_index": lambda: map_vals_to_index(atlas, key_vals),
+            "LabelIndex": lambda: LabelIndex(atlas),
+            "LabelIndex.map": lambda: index.map(key_vals)}
+    records = []
+    reference = None
+    if spec["oracles"]:
+        record, reference = _record("map_vals_to_index", "_loop_map_vals_to_index", size, 1,
+                                    lambda: _loop_map_vals_to_index(atlas, key_vals), repeats=1)
+        records.append(record)
+    for case, run in runs.items():
+        record, output = _record("map_vals_to_index", case, size, 1, run, reference,
+                                 None if case == "LabelIndex" else _max_difference)
+        reference = output if reference is None else reference
+        records.append(record)
+    return records
+
+
+def suite_bin_statistics_by_index(size, spec, core_counts, rng):
+    """
+    bin_statistics_by_index() (mean, several statistics, and a batch of subjects) against the
+    _loop_mean_statistics_by_index oracle and scipy.stats.binned_statistic
+    """
+    atlas = _atlas(spec, rng)
+    values = rng.random(spec["volume"], dtype=np.float32)
+    cohort = rng.random((8,) + spec["volume"], dtype=np.float32)
+    index = LabelIndex(atlas)
+    records = []
+    reference = None
+    if spec["oracles"]:
+        record, reference = _record("bin_statistics_by_index", "_loop_mean_statistics_by_index", size, 1,
+                                    lambda: _loop_mean_statistics_by_index(atlas, values)["stat"], repeats=1)
+        records.append(record)
+    runs = {"scipy binned_statistic": lambda: _binned_statistic_by_index(atlas, values)["stat"],
+            "mean": lambda: bin_statistics_by_index(atlas, values)["stat"],
+            "mean (LabelIndex)": lambda: bin_statistics_by_index(index, values)["stat"],
+            "6 statistics (LabelIndex)": lambda: bin_statistics_by_index(index, values, ["mean", "std", "count", "sum", "min", "max"])["stat"]["mean"]}
+    for case, run in runs.items():
+        record, output = _record("bin_statistics_by_index", case, size, 1, run, reference, _max_difference)
+        reference = output if reference is None else reference
+        records.append(record)
+    batch = lambda: bin_statistics_by_index(index, cohort)["stat"]
+    expected = np.array([bin_statistics_by_index(index, subject)["stat"] for subject in cohort])
+    records.append(_record("bin_statistics_by_index", "mean of 8 subjects (LabelIndex)", size, 1, batch, expected, _max_difference)[0])
+    return records
+
+
+SUITE = {
+    "Parallelize": suite_parallelize,
+    "eigengame": suite_eigengame,
+    "linreg": suite_linreg,
+    "map_vals_to_index": suite_map_vals_to_index,
+    "bin_statistics_by_index": suite_bin_statistics_by_index,
+}
+
+
+def run_suite(sizes=("tiny", "small"), core_counts=None, benchmarks=None, seed=0):
+    """
+    Run the benchmarks of SUITE for every size of SIZES and number of cores.
+
+    :param sizes: (list of str) the keys of SIZES to run
+    :param core_counts: (list of int) the numbers of cores for Parallelize and linreg. Default = powers of two up to the
+                        number of cores
+    :param benchmarks: (list of str) the keys of SUITE to run. Default = all
+    :param seed: (int) seed of the synthetic inputs
+    :return: list of records, dicts with the benchmark, case, size, cores, wall time (s), peak memory (bytes) and error
+             (difference to the oracle or reference run, None if there is none)
+    """
+    core_counts = _core_counts(core_counts)
+    records = []
+    for size in sizes:
+        for name in benchmarks or SUITE:
+            records.extend(SUITE[name](size, SIZES[size], core_counts, np.random.default_rng(seed)))
+    return records
+
+
+def compare(records, baseline, threshold=1.25, min_wall=0.01):
+    """
+    Find the regressions of records with respect to the records of an earlier run of the suite
+
+    :param threshold: (float) a wall time or peak memory more than threshold times that of the baseline is a regression
+    :param min_wall: (float) wall times below this (in s) are too noisy to be compared
+    :return: list of (key, quantity, baseline value, new value)
+    """
+    key = lambda record: (record["benchmark"], record["case"], record["size"], record["cores"])
+    previous = {key(record): record for record in baseline}
+    regressions = []
+    for record in records:
+        old = previous.get(key(record))
+        if old is None:
+            continue
+        if record["wall"] > threshold * old["wall"] and record["wall"] > min_wall:
+            regressions.append((key(record), "wall", old["wall"], record["wall"]))
+        if record["peak_memory"] > threshold * old["peak_memory"]:
+            regressions.append((key(record), "peak_memory", old["peak_memory"], record["peak_memory"]))
+    return regressions
+
+
+def _print_records(records):
+    print(f"    {'benchmark':<24} {'case':<34} {'size':<7} {'cores':>5} {'wall (s)':>10} {'peak (MiB)':>11} {'error':>9}")
+    for record in records:
+        error = "" if record["error"] is None else f"{record['error']:.2e}"
+        print(f"    {record['benchmark']:<24} {record['case']:<34} {record['size']:<7} {record['cores']:>5} "
+              f"{record['wall']:>10.4f} {record['peak_memory'] / 2**20:>11.1f} {error:>9}")
+
+
+def _print_comparisons():
+    print("Parallelize on a skewed workload")
+    for name, (wall, idle) in bench_parallelize_skewed().items():
+        print(f"    {name:<24} wall {wall:7.3f} s    idle {100 * idle:5.1f} %")
+
+    print("EigenGame vs SVD")
+    for name, (wall, angle) in bench_eigengame().items():
+        print(f"    {name:<24} wall {wall:7.3f} s    max angle {angle:8.4f} deg")
+
+    print("Randomized PCA solvers vs EigenGame")
+    for name, (wall, angle) in bench_pca_solvers().items():
+        print(f"    {name:<24} wall {wall:7.3f} s    max angle {angle:8.4f} deg")
+
+    print("linreg vs the pingouin loop")
+    for name, (wall, error) in bench_linreg().items():
+        print(f"    {name:<28} wall {wall:7.3f} s    max |t - t_loop| {error:.2e}")
+
+    print("Parcellation of a synthetic cohort")
+    for name, (wall, rate) in bench_parcellate().items():
+        print(f"    {name:<32} wall {wall:7.3f} s    {rate:7.1f} subjects/s")
+
+    print("Import time")
+    for name, wall in bench_import_time().items():
+        print(f"    {name:<40} {1000 * wall:7.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark suite of NeuralABC_tools")
+    parser.add_argument("--sizes", nargs="+", default=["tiny", "small"], choices=list(SIZES))
+    parser.add_argument("--cores", nargs="+", type=int, default=None)
+    parser.add_argument("--benchmarks", nargs="+", default=None, choices=list(SUITE))
+    parser.add_argument("--save", help="write the results to this json file")
+    parser.add_argument("--compare", help="json file of an earlier run, exit with status 1 on a regression")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    parser.add_argument("--comparisons", action="store_true", help="also compare with the implementations that were replaced")
+    args = parser.parse_args()
+
+    records = run_suite(args.sizes, args.cores, args.benchmarks)
+    _print_records(records)
+    if args.save:
+        machine = {"python": platform.python_version(), "numpy": np.__version__, "cpu_count": multiprocessing.cpu_count(),
+                   "platform": platform.platform()}
+        with open(args.save, "w") as file:
+            json.dump({"machine": machine, "records": records}, file, indent=1)
+    if args.comparisons:
+        _print_comparisons()
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(records, json.load(file)["records"], args.threshold)
+        for key, quantity, old, new in regressions:
+            print(f"REGRESSION {key}: {quantity} {old:.4g} -> {new:.4g}")
+        sys.exit(1 if regressions else 0)
@@ -1,6 +1,20 @@
-from ..arrays import (map_vals_to_index, _loop_map_vals_to_index)
+from ..arrays import (mm_norm, map_vals_to_index, LabelIndex, bin_statistics_by_index, parcellate, _loop_map_vals_to_index,
+                      _binned_statistic_by_index)
+from ..Parallelize import Parallelize, ParallelExecutor, ElementError, worker_state
+from ..conv_functions import linreg, _loop_linreg, _linreg_design, _permutation_tests
+from ..eigengame import EigenGame, eigengame, _loop_eigengame, _loop_explained_variance_ratio
+from .benchmarks import run_suite, compare
+
+import functools
+import importlib
+import os
+import subprocess
+import sys
+import tracemalloc
+import warnings
 
 import numpy as np
+import pytest
 
 def test_map_vals_to_index():
     rng = np.random.default_rng()
@@ -11,3 +25,586 @@ def test_map_vals_to_index():
     res_2 = _loop_map_vals_to_index(idx_array, key_vals)
 
     assert np.allclose(res_1, res_2)
+
+
+def test_label_index():
+    rng = np.random.default_rng(0)
+    atlas = rng.integers(0, 50, (20, 30, 10)) * 3  # small labels use the lookup table
+    scattered = rng.integers(-5, 5, (20, 30)) * 10**9  # the others are sorted
+    for idx_array in (atlas, scattered):
+        index = LabelIndex(idx_array)
+        key_vals = rng.random((4, index.labels.size))
+
+        stack = index.map(key_vals)
+        assert stack.shape == (4,) + idx_array.shape
+        for vals, volume in zip(key_vals, stack):
+            assert np.array_equal(volume, _loop_map_vals_to_index(idx_array, vals))
+        assert np.array_equal(map_vals_to_index(index, key_vals[0]), stack[0])
+
+    with pytest.raises(ValueError):
+        index.map(np.zeros(3))
+
+
+def test_bin_statistics_by_index():
+    rng = np.random.default_rng(0)
+    idx_array = rng.integers(0, 8, (20, 30)) * 2
+    val_array = rng.random((20, 30))
+    val_array[rng.random((20, 30)) < 0.1] = np.nan
+    val_array[idx_array == 6] = np.nan  # a region without any value
+
+    statistics = ["mean", "std", "median", "count", "sum", "min", "max"]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for ignore_zero_index in (True, False):
+            res = bin_statistics_by_index(idx_array, val_array, statistics, ignore_zero_index)
+            for statistic in statistics:
+                expected = _binned_statistic_by_index(idx_array, val_array, statistic, ignore_zero_index)
+                assert np.allclose(res["stat"][statistic], expected["stat"], equal_nan=True)
+                assert np.array_equal(res["bin_num"], expected["bin_num"])
+
+    #the values of one subject are ravelled, whatever the shapes of the two arrays
+    expected = _binned_statistic_by_index(idx_array, val_array)
+    for index, values in ((idx_array, val_array.ravel()), (idx_array.ravel(), val_array), (idx_array, val_array.T.copy().T)):
+        res = bin_statistics_by_index(index, values)
+        assert np.allclose(res["stat"], expected["stat"], equal_nan=True)
+        assert np.array_equal(res["bin_num"].ravel(), expected["bin_num"].ravel())
+
+    #A cohort at once, (subjects, ...) or (subjects, voxels), with the sort order of the LabelIndex reused
+    cohort = rng.random((5, 20, 30))
+    index = LabelIndex(idx_array)
+    res = bin_statistics_by_index(index, cohort, ["mean", "max"])
+    flat = bin_statistics_by_index(index, cohort.reshape(5, -1), "mean")
+    assert res["stat"]["mean"].shape == (5, 7) and res["bin_num"].shape == (20, 30)
+    for subject in range(5):
+        assert np.allclose(res["stat"]["mean"][subject], _binned_statistic_by_index(idx_array, cohort[subject])["stat"])
+        assert np.allclose(res["stat"]["max"][subject], _binned_statistic_by_index(idx_array, cohort[subject], "max")["stat"])
+    assert np.allclose(flat["stat"], res["stat"]["mean"])
+    assert np.array_equal(res["bin_num"], _binned_statistic_by_index(idx_array, cohort[0])["bin_num"])
+
+
+def test_parcellate(tmp_path):
+    rng = np.random.default_rng(0)
+    atlas = rng.integers(0, 6, (8, 9, 10))
+    cohort = rng.random((7, 8, 9, 10))
+    paths = []
+    for subject, volume in enumerate(cohort):
+        paths.append(tmp_path / f"sub-{subject}.npy")
+        np.save(paths[-1], volume)
+    np.save(tmp_path / "atlas.npy", atlas.astype(float))
+
+    expected = bin_statistics_by_index(atlas, cohort, ["mean", "max"])["stat"]
+    res = parcellate(paths, tmp_path / "atlas.npy", ["mean", "max"], num_cores=2)
+    assert np.array_equal(res["labels"], np.arange(1, 6))
+    assert np.allclose(res["stat"]["mean"], expected["mean"]) and np.allclose(res["stat"]["max"], expected["max"])
+
+    #a 4-D array with the subjects along the last axis, as in a 4-D NIfTI file
+    res = parcellate(np.moveaxis(cohort, 0, -1), LabelIndex(atlas), "mean", backend="process")
+    assert np.allclose(res["stat"], expected["mean"])
+
+
+def _row_stats(row):
+    return np.array([row.sum(), row.max()])
+
+
+def test_parallelize():
+    data = np.random.default_rng(0).random((37, 50))
+    expected = np.array([_row_stats(row) for row in data])
+
+    assert np.allclose(Parallelize(data, _row_stats, 4), expected)
+
+
+def test_parallelize_shared_memory():
+    data = np.random.default_rng(0).random((37, 50))
+    expected = np.array([_row_stats(row) for row in data])
+
+    for start_method in ("fork", "spawn"):
+        res = Parallelize(data, _row_stats, 4, shared_memory=True, start_method=start_method)
+        assert res.dtype == expected.dtype
+        assert np.allclose(res, expected)
+
+
+def _head_view(row):
+    return row[:2]
+
+
+def test_parallelize_shared_memory_views():
+    #outputs viewing the shared input must outlive the worker's access to it
+    data = np.random.default_rng(0).random((37, 50))
+
+    assert np.array_equal(Parallelize(data, _head_view, 2, shared_memory=True, chunksize=4), data[:, :2])
+    res = Parallelize(data, _head_view, 2, shared_memory=True, chunksize=4, ragged="list")
+    assert np.array_equal(np.array(res), data[:, :2])
+
+
+def test_parallelize_imap():
+    data = np.random.default_rng(0).random((37, 50))
+    expected = [_row_stats(row) for row in data]
+
+    res = list(Parallelize.imap(data, _row_stats, 2, chunksize=3, max_pending=2))
+    assert np.allclose(res, expected)
+
+    res = list(Parallelize.imap((row for row in data), _row_stats, 2, chunksize=5))
+    assert np.allclose(res, expected)
+
+
+def _load_offset(offset):
+    return offset
+
+
+def _add_worker_state(row):
+    return row + worker_state()
+
+
+def test_parallel_executor():
+    data = np.random.default_rng(0).random((37, 50))
+
+    with ParallelExecutor(2, initializer=_load_offset, initargs=(10,)) as executor:
+        for chunksize in (None, 1, 7):
+            assert np.allclose(executor.map(data, _add_worker_state, chunksize=chunksize), data + 10)
+        assert np.allclose(executor.map(data, _add_worker_state, shared_memory=True), data + 10)
+        assert np.allclose(list(executor.imap(data, _add_worker_state, chunksize=4)), data + 10)
+
+
+def _block_stats(block):
+    return np.stack([block.sum(axis=1), block.max(axis=1)], axis=1)
+
+
+def test_parallelize_backends():
+    data = np.random.default_rng(0).random((37, 50))
+    expected = np.array([_row_stats(row) for row in data])
+
+    assert np.allclose(Parallelize(data, _row_stats, 4, backend="thread"), expected)
+    assert np.allclose(Parallelize(data, _block_stats, 4, backend="batch", chunksize=5), expected)
+    assert np.allclose(Parallelize(data, _row_stats, 4, backend="auto"), expected)
+    assert np.allclose(Parallelize(list(data), _row_stats, 4, backend="auto"), expected)
+
+
+def _first_n(row):
+    return row[:int(row[0] * 10) + 1]
+
+
+def test_parallelize_out_and_ragged(tmp_path):
+    data = np.random.default_rng(0).random((37, 50))
+    expected = np.array([_row_stats(row) for row in data])
+
+    out = np.zeros((37, 2))
+    assert Parallelize(data, _row_stats, 2, out=out) is out
+    assert np.allclose(out, expected)
+
+    for backend in ("process", "thread"):
+        res = Parallelize(data, _row_stats, 2, backend=backend, out=tmp_path / f"{backend}.npy")
+        assert isinstance(res, np.memmap)
+        assert np.allclose(np.load(tmp_path / f"{backend}.npy"), expected)
+
+    expected = [_first_n(row) for row in data]
+    res = Parallelize(data, _first_n, 2, chunksize=4, ragged="list")
+    assert all(np.array_equal(a, b) for a, b in zip(res, expected))
+
+    for out in (None, tmp_path / "values.bin"):
+        values, offsets = Parallelize(data, _first_n, 2, chunksize=4, ragged="offsets", out=out)
+        assert all(np.array_equal(values[offsets[i]:offsets[i + 1]], expected[i]) for i in range(len(data)))
+
+
+def _int_then_float(row):
+    return int(row[0]) if row[0] < 10 else row[0] + 0.5
+
+
+def _float32_then_float64(row):
+    return row[:1].astype(np.float32) if row[0] < 10 else row[:1] + 1e-9
+
+
+def test_parallelize_output_types(tmp_path):
+    #the result of the workers' outputs gets their common type, whatever chunk finishes first
+    data = np.arange(40.0)[:, None]
+    expected = [_int_then_float(row) for row in data]
+    res = Parallelize(data, _int_then_float, 2, chunksize=5)
+    assert res.dtype == np.float64 and np.array_equal(res[:, 0], expected)
+    res = Parallelize(data, _float32_then_float64, 2, chunksize=5)
+    assert res.dtype == np.float64 and np.array_equal(res[10:, 0], data[10:, 0] + 1e-9)
+
+    #the workers write into a result of the type of the first chunk, in which later outputs would be truncated
+    for kwargs in ({"backend": "thread"}, {"shared_memory": True}, {"out": tmp_path / "out.npy"}):
+        with pytest.raises(ValueError, match="dtype"):
+            Parallelize(data, _int_then_float, 2, chunksize=5, **kwargs)
+        res = Parallelize(data, _int_then_float, 2, chunksize=5, dtype=np.float64, **{**kwargs, "out": None})
+        assert np.array_equal(res[:, 0], expected)
+
+
+def _shrinking(row):
+    return row[:3] if row[0] < 10 else -1.0
+
+
+def test_parallelize_output_sizes(tmp_path):
+    #an output of size 1 after outputs of size 3 must not be broadcast over its row
+    data = np.arange(40.0)[:, None] * np.ones(3)
+    for kwargs in ({}, {"backend": "thread"}, {"shared_memory": True}, {"out": tmp_path / "out.npy"}):
+        with pytest.raises(ValueError, match="ragged"):
+            Parallelize(data, _shrinking, 2, chunksize=5, **kwargs)
+
+
+def test_parallelize_profile():
+    data = np.random.default_rng(0).random((37, 50))
+    expected = np.array([_row_stats(row) for row in data])
+    progress = []
+
+    for backend in ("process", "thread"):
+        res, stats = Parallelize(data, _row_stats, 2, chunksize=5, backend=backend, profile=True,
+                                 callback=lambda s: progress.append(s.done))
+        assert np.allclose(res, expected)
+        assert stats.done == 37 and progress[-1] == 37
+        assert not np.isnan(stats.item_times).any()
+        assert sum(worker["items"] for worker in stats.workers.values()) == 37
+        assert "37/37 elements" in repr(stats)
+
+
+def _fail_on_large(row):
+    if row[0] > 0.8:
+        raise RuntimeError("too large")
+    return row[:2]
+
+
+def _negate_first_failing(row):
+    if row[0] > 0.8:
+        raise RuntimeError("too large")
+    return -row[:2]
+
+
+def _negate_first(row):
+    return -row[:2]
+
+
+def _scale_first(row, k):
+    return k * row[:2]
+
+
+def test_parallelize_errors_and_checkpoint(tmp_path):
+    data = np.random.default_rng(0).random((37, 50))
+    failing = data[:, 0] > 0.8
+
+    for backend in ("process", "thread"):
+        res, failures = Parallelize(data, _fail_on_large, 2, chunksize=4, backend=backend, errors="return", retries=1)
+        assert sorted(failures) == list(np.flatnonzero(failing))
+        assert all(isinstance(failure, ElementError) for failure in failures.values())
+        assert np.isnan(res[failing]).all()
+        assert np.allclose(res[~failing], data[~failing, :2])
+
+    #the failed elements are missing from the checkpoint, so only they are computed by the fixed function
+    Parallelize(data, _negate_first_failing, 2, chunksize=4, errors="return", checkpoint=tmp_path / "a", checkpoint_key="negate")
+    res = Parallelize(data, _negate_first, 2, chunksize=4, checkpoint=tmp_path / "a", checkpoint_key="negate")
+    assert np.allclose(res, -data[:, :2])
+
+    #a checkpoint is never resumed with another function, other arguments of a partial, or other data
+    with pytest.raises(ValueError, match="function"):
+        Parallelize(data, _negate_first, 2, chunksize=4, checkpoint=tmp_path / "a")
+    Parallelize(data, functools.partial(_scale_first, k=2), 2, chunksize=4, checkpoint=tmp_path / "b")
+    with pytest.raises(ValueError, match="function"):
+        Parallelize(data, functools.partial(_scale_first, k=100), 2, chunksize=4, checkpoint=tmp_path / "b")
+    with pytest.raises(ValueError, match="dtype"):
+        Parallelize(data.astype(np.float32), functools.partial(_scale_first, k=2), 2, chunksize=4, checkpoint=tmp_path / "b")
+    with pytest.raises(ValueError, match="checkpoint_key"):
+        Parallelize(data, lambda row: row[:2], 2, backend="thread", checkpoint=tmp_path / "c")
+
+
+def _low_rank_data(n_samples, n_features, rank=20, noise=0.01, seed=0):
+    rng = np.random.default_rng(seed)
+    left = np.linalg.qr(rng.standard_normal((n_samples, rank)))[0]
+    right = np.linalg.qr(rng.standard_normal((n_features, rank)))[0]
+    return left @ np.diag(np.geomspace(10, 0.5, rank)) @ right.T + noise * rng.standard_normal((n_samples, n_features))
+
+
+def test_eigengame():
+    data = _low_rank_data(200, 300)
+    reference = _loop_eigengame(data, 5)
+
+    assert np.allclose(eigengame(data, 5), reference)
+    assert np.allclose(EigenGame(5).fit_transform(data.T).T, reference)
+
+    #The parallel update reaches the same eigenvectors, up to their sign
+    parallel = eigengame(data, 5, update="parallel")
+    assert np.allclose(np.abs(np.sum(parallel * reference, axis=1)), 1, atol=1e-6)
+    svd = np.linalg.svd(data, full_matrices=False)[2][:5]
+    assert np.allclose(np.abs(np.sum(parallel * svd, axis=1)), 1, atol=1e-6)
+
+
+def test_eigengame_stream(tmp_path):
+    data = _low_rank_data(4000, 100, rank=5, noise=0.001)
+    svd = np.linalg.svd(data, full_matrices=False)[2][:3]
+    stored = np.lib.format.open_memmap(tmp_path / "data.npy", mode="w+", dtype=data.dtype, shape=data.shape)
+    stored[:] = data
+    stored.flush()
+
+    model = EigenGame(3)
+    vectors = model.fit_stream(np.load(tmp_path / "data.npy", mmap_mode="r"), batch_size=100, epochs=5)
+    assert vectors.shape == (100, 3) and model.n_samples_seen == 20000
+    assert np.allclose(np.abs(np.sum(vectors.T * svd, axis=1)), 1, atol=1e-3)
+    singular_values = np.linalg.svd(data, compute_uv=False)
+    assert np.allclose(model.explained_variance_ratio_, singular_values[:3]**2 / np.sum(singular_values**2), atol=1e-3)
+
+    #An iterable of blocks is read once, block by block
+    blocks = (data[start:start + 100] for epoch in range(5) for start in range(0, 4000, 100))
+    vectors = EigenGame(3).fit_stream(blocks)
+    assert np.allclose(np.abs(np.sum(vectors.T * svd, axis=1)), 1, atol=1e-3)
+
+    #blocks of zero rows (masked or padded samples) leave the eigenvectors as they are
+    padded = np.concatenate((np.zeros((100, 100)), data[:2000], np.zeros((100, 100)), data[2000:]))
+    model = EigenGame(3)
+    vectors = model.fit_stream(padded, batch_size=100, epochs=5)
+    assert np.isfinite(vectors).all()
+    assert np.allclose(np.abs(np.sum(vectors.T * svd, axis=1)), 1, atol=1e-3)
+
+
+def test_eigengame_convergence():
+    data = _low_rank_data(200, 300)
+    svd = np.linalg.svd(data, full_matrices=False)[2][:5]
+
+    for update in ("sequential", "parallel"):
+        vectors, info = eigengame(data, 5, epochs=1000, update=update, tol=1e-10, return_info=True)
+        assert info["converged"].all() and (info["n_iter"] < 1000).all() and (info["change"] < 1e-10).all()
+        assert np.allclose(np.abs(np.sum(vectors * svd, axis=1)), 1)
+
+        #Refitting a slightly different cohort from the previous eigenvectors takes fewer iterations
+        noisy = data + 1e-3 * np.random.default_rng(1).standard_normal(data.shape)
+        warm = eigengame(noisy, 5, epochs=1000, update=update, tol=1e-10, init=vectors, return_info=True)[1]
+        assert warm["converged"].all() and (warm["n_iter"] < info["n_iter"]).all()
+
+    #On data with a small scale, the fixed learning rate is too small, the adaptive one is not
+    small = data / 100
+    with pytest.warns(RuntimeWarning, match="did not converge"):
+        eigengame(small, 5, epochs=300, tol=1e-10)
+    model = EigenGame(5, epochs=300, tol=1e-10, adaptive=True)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        vectors = model.fit_transform(small.T)
+    assert model.converged_.all() and model.n_iter_.max() < 300
+    assert np.allclose(np.abs(np.sum(vectors.T * svd, axis=1)), 1)
+
+
+def test_eigengame_explained_variance():
+    data = _low_rank_data(200, 300)
+    singular_values = np.linalg.svd(data, compute_uv=False)
+
+    model = EigenGame(5)
+    model.fit_transform(data.T)
+    assert np.allclose(model.explained_variance_ratio_, singular_values[:5]**2 / np.sum(singular_values**2))
+    assert np.allclose(model.explained_variance_, singular_values[:5]**2 / 199)
+    assert np.allclose(model.get_explained_variance_ratio(), _loop_explained_variance_ratio(data, model.eigenvectors))
+
+
+
+def test_randomized_pca(tmp_path, monkeypatch):
+    data = _low_rank_data(200, 300)
+    reference = np.linalg.svd(data, full_matrices=False)[2][:5]
+
+    for solver in ("randomized", "block_krylov"):
+        vectors = eigengame(data, 5, solver=solver, seed=0)
+        assert np.allclose(np.abs(np.sum(vectors * reference, axis=1)), 1)
+    with pytest.raises(ValueError):
+        eigengame(data, 5, solver="power")
+
+    # same interface and explained variance as the eigengame solver
+    model = EigenGame(5, solver="randomized", seed=0)
+    vectors = model.fit_transform(data.T)
+    assert vectors.shape == (300, 5) and model.components.shape == (200, 5)
+    expected = EigenGame(5)
+    expected.fit_transform(data.T)
+    assert np.allclose(model.explained_variance_ratio_, expected.explained_variance_ratio_)
+    assert np.allclose(model.get_explained_variance_ratio(), _loop_explained_variance_ratio(data, model.eigenvectors))
+    with pytest.raises(ValueError):
+        model.partial_fit(data)
+
+    # a memmap is read a few rows (or columns, when it is transposed) at a time
+    monkeypatch.setattr(importlib.import_module("..eigengame", __package__), "_PCA_BLOCK_ELEMENTS", 1000)
+    for stored in (data, data.T):
+        np.save(tmp_path / "data.npy", stored)
+        memmap = np.load(tmp_path / "data.npy", mmap_mode="r")
+        blocked = EigenGame(5, solver="randomized", seed=0)
+        assert np.allclose(blocked.fit_transform(memmap.T if stored is data else memmap), vectors)
+        assert np.allclose(blocked.components, model.components)
+        assert np.allclose(blocked.explained_variance_, model.explained_variance_)
+
+
+def _assert_same_linreg(results, expected):
+    assert results.keys() == expected.keys()
+    for key in expected:
+        assert results[key].keys() == expected[key].keys()
+        for col in expected[key]:
+            if key == "residuals":
+                for col2 in expected[key][col]:
+                    assert np.allclose(results[key][col][col2], expected[key][col][col2])
+            else:
+                assert np.allclose(results[key][col], expected[key][col])
+
+
+def test_linreg():
+    import pandas as pd
+
+    rng = np.random.default_rng(0)
+    iv = pd.DataFrame(rng.standard_normal((30, 4)), columns=["var1", "var2", "var3", "var4"])
+    dv = rng.standard_normal((30, 6)) + iv[["var1"]].to_numpy()
+    cov = rng.standard_normal((30, 2))
+
+    _assert_same_linreg(linreg(iv, dv, verbose=0), _loop_linreg(iv, dv, verbose=0))
+    _assert_same_linreg(linreg(iv, dv, cov, verbose=0), _loop_linreg(iv, dv, cov, verbose=0))
+    _assert_same_linreg(linreg(iv, dv, cov, verbose=0, residualize=False), _loop_linreg(iv, dv, cov, verbose=0))
+
+
+def test_linreg_degenerate_iv():
+    import pandas as pd
+
+    rng = np.random.default_rng(1)
+    cov = rng.standard_normal((30, 2))
+    #an IV that the covariates explain entirely makes the model rank deficient
+    iv = pd.DataFrame({"var1": rng.standard_normal(30), "same_as_cov": 2 * cov[:, 0] + 1})
+    dv = rng.standard_normal((30, 3))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        expected = _loop_linreg(iv, dv, cov, verbose=0)
+        results = linreg(iv, dv, cov, verbose=0)
+    _assert_same_linreg(results, expected)
+
+
+def test_linreg_chunked_arrays(tmp_path):
+    rng = np.random.default_rng(2)
+    iv = rng.standard_normal((40, 3))
+    dv = rng.standard_normal((40, 25))
+    cov = rng.standard_normal((40, 2))
+    np.save(tmp_path / "dv.npy", dv)
+
+    expected = linreg(iv, dv, cov, verbose=0)
+    results = linreg(iv, np.load(tmp_path / "dv.npy", mmap_mode="r"), cov, verbose=0, n_jobs=2, chunksize=4,
+                     output="arrays", out_dir=tmp_path / "results")
+
+    assert results["corr_coefs"] is None and list(results["dv_columns"]) == list(range(25))
+    for key in ("r_squared", "reg_coefs", "p_values", "t_values"):
+        assert isinstance(results[key], np.memmap) and results[key].shape == (3, 25)
+        assert np.allclose(results[key], [expected[key][col] for col in range(3)])
+    assert results["residuals"].shape == (3, 40, 25)
+    assert np.allclose(results["residuals"][1, :, 7], expected["residuals"][1][7])
+    assert np.allclose(np.load(tmp_path / "results" / "t_values.npy"), results["t_values"])
+
+
+def test_linreg_permutations():
+    rng = np.random.default_rng(3)
+    iv = rng.standard_normal((40, 2))
+    cov = rng.standard_normal((40, 2))
+    dv = rng.standard_normal((40, 30))
+    dv[:, 0] += 2 * iv[:, 0]
+
+    results = linreg(iv, dv, cov, verbose=0, output="arrays", n_perm=1000, seed=0)
+    assert np.abs(results["perm_p_values"] - results["p_values"]).max() < 0.05
+    assert results["fwer_p_values"][0, 0] == 1 / 1001 and (results["fwer_p_values"] >= results["perm_p_values"]).all()
+
+    #The same seed gives the same p-values, however the DV columns are chunked
+    chunked = linreg(iv, dv, cov, verbose=0, n_perm=1000, seed=0, chunksize=7, n_jobs=2)
+    assert np.array_equal(chunked["fwer_p_values"][1], results["fwer_p_values"][1])
+    assert np.array_equal(chunked["perm_p_values"][0], results["perm_p_values"][0])
+
+    with pytest.raises(ValueError):
+        linreg(iv, dv, cov, verbose=0, n_perm=10, residualize=False)
+
+    #Smith procedure: the |t| of a permutation is that of the permuted residualized IV in the full model with covariates
+    design = _linreg_design(iv, cov, True)
+    design["permutations"] = np.array([rng.permutation(40) for perm in range(3)])
+    y_res = dv - design["basis"] @ (design["basis"].T @ dv)
+    null_max = _permutation_tests(design, y_res, np.einsum("ij,ij->j", y_res, y_res), np.zeros((2, 30)))[1]
+    for i in range(2):
+        for k, perm in enumerate(design["permutations"]):
+            model = np.column_stack((np.ones(40), design["x_res"][perm, i], cov))
+            coef, ss_res = np.linalg.lstsq(model, dv, rcond=None)[:2]
+            se = np.sqrt(ss_res / (40 - 4) * np.linalg.inv(model.T @ model)[1, 1])
+            assert np.isclose(null_max[i, k], np.abs(coef[1] / se).max())
+
+
+_IMPORT_CHECK = """
+import sys
+import NeuralABC_tools
+assert "scipy" not in sys.modules and "numpy" not in sys.modules
+from NeuralABC_tools import Parallelize
+assert "scipy" not in sys.modules
+import NeuralABC_tools.Parallelize
+from NeuralABC_tools.conv_functions import linreg
+assert NeuralABC_tools.Parallelize is Parallelize and callable(Parallelize)
+from NeuralABC_tools import *
+assert map_vals_to_index is NeuralABC_tools.arrays.map_vals_to_index
+"""
+
+
+def test_lazy_imports():
+    # a fresh interpreter, as the modules imported by the other tests are cached in this one
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])))
+    subprocess.run([sys.executable, "-c", _IMPORT_CHECK], env=env, check=True)
+
+
+def test_benchmark_suite():
+    records = run_suite(["tiny"], core_counts=[1])
+    assert {record["benchmark"] for record in records} == {"Parallelize", "eigengame", "linreg", "map_vals_to_index",
+                                                           "bin_statistics_by_index"}
+    for record in records:
+        assert record["wall"] > 0 and record["peak_memory"] >= 0
+        if record["error"] is not None:
+            # eigengame reports the angle to the SVD components in degrees
+            assert record["error"] < (1 if record["benchmark"] == "eigengame" else 1e-6), record
+
+    slower = [dict(record, wall=2 * record["wall"] + 1) for record in records]
+    assert compare(records, records) == []
+    assert len(compare(slower, records)) == len(records)
+
+
+def _peak_allocation(run):
+    tracemalloc.start()
+    try:
+        output = run()
+        return output, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_float32_paths():
+    rng = np.random.default_rng(0)
+    volume = rng.random((100, 100, 60), dtype=np.float32)
+    atlas = rng.integers(0, 21, volume.shape)
+    key_vals = rng.random(21).astype(np.float32)
+
+    # the results keep the precision of the inputs
+    assert mm_norm(volume).dtype == np.float32
+    assert mm_norm(atlas).dtype == np.float64
+    assert map_vals_to_index(atlas, key_vals).dtype == np.float32
+    assert _loop_map_vals_to_index(atlas, key_vals).dtype == np.float32
+    assert map_vals_to_index(atlas, key_vals.astype(np.float64), dtype=np.float32).dtype == np.float32
+
+    # out= writes in place without a temporary of the size of the volume
+    expected = mm_norm(volume.astype(np.float64))
+    normalized, peak = _peak_allocation(lambda: mm_norm(volume, out=volume))
+    assert normalized is volume and peak < volume.nbytes / 4
+    assert np.allclose(volume, expected, atol=1e-6)
+
+    index = LabelIndex(atlas)
+    out = np.empty(atlas.shape, dtype=np.float32)
+    mapped, peak = _peak_allocation(lambda: map_vals_to_index(index, key_vals, out=out))
+    assert mapped is out and peak < out.nbytes / 4
+    assert np.array_equal(out, _loop_map_vals_to_index(atlas, key_vals))
+
+    # eigengame runs in float32 on float32 data, as accurately as the float32 rounding allows
+    data = _low_rank_data(200, 300)
+    reference = eigengame(data, 5)
+    for update in ("sequential", "parallel"):
+        vectors = eigengame(data.astype(np.float32), 5, update=update)
+        assert vectors.dtype == np.float32
+        assert np.allclose(np.abs(np.sum(vectors * reference, axis=1)), 1, atol=1e-4)
+    assert eigengame(data, 5, dtype=np.float32).dtype == np.float32
+    model = EigenGame(5)
+    model.fit_transform(data.T.astype(np.float32))
+    assert model.eigenvectors.dtype == np.float32 and model.components.dtype == np.float32
+    assert np.allclose(model.explained_variance_ratio_, _loop_explained_variance_ratio(data, reference), atol=1e-5)
+    model = EigenGame(5).partial_fit(data[:100].astype(np.float32))
+    assert model.eigenvectors.dtype == np.float32
+
+    # Parallelize stores the outputs in the requested type
+    rows = rng.random((20, 6))
+    for backend in ("process", "thread"):
+        processed = Parallelize(rows, np.sqrt, 2, backend=backend, dtype=np.float32)
+        assert processed.dtype == np.float32 and np.allclose(processed, np.sqrt(rows))
+    values, offsets = Parallelize(rows, np.sqrt, 2, ragged="offsets", dtype=np.float32)
+    assert values.dtype == np.float32 and np.allclose(values, np.sqrt(rows).ravel())